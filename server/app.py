@@ -1,19 +1,87 @@
+import collections
+import contextlib
+import dbm
 import hashlib
 import hmac
-import itertools
 import json
 import logging
 import os
 import random
 import shelve
+import shlex
+import sqlite3
 import textwrap
+import threading
+import time
 
 import arrow
 import flask
 import humanhash
+import prometheus_client
+from prometheus_client import Counter, Histogram
+from prometheus_client import multiprocess
+from prometheus_client.core import GaugeMetricFamily
 from slackclient import SlackClient
 
-logging.basicConfig(level=logging.DEBUG)
+#: Minimum level of log messages, e.g. DEBUG, INFO or WARNING.
+LOG_LEVEL = os.getenv('CRUSHER_LOG_LEVEL', 'INFO')
+#: `json` to log one json object per line, or `text`.
+LOG_FORMAT = os.getenv('CRUSHER_LOG_FORMAT', 'text')
+#: Messages longer than this many characters are truncated.
+LOG_MAX_CHARS = int(os.getenv('CRUSHER_LOG_MAX_CHARS', '4096'))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as single line json objects.
+    """
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%SZ'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class TruncatingFilter(logging.Filter):
+    """
+    Caps the length of log messages. As a handler filter it only sees records
+    that are actually emitted, so messages below the log level are never
+    formatted at all.
+    """
+
+    def __init__(self, max_chars):
+        super(TruncatingFilter, self).__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_chars:
+            record.msg = "{}... ({} characters truncated)".format(
+                message[:self.max_chars],
+                len(message) - self.max_chars,
+            )
+            record.args = None
+        return True
+
+
+def configure_logging(level, format, max_chars):
+    handler = logging.StreamHandler()
+    handler.addFilter(TruncatingFilter(max_chars))
+    if format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.basicConfig(level=level.upper(), handlers=[handler])
+
+
+configure_logging(LOG_LEVEL, LOG_FORMAT, LOG_MAX_CHARS)
 LOGGER = logging.getLogger(__name__)
 
 app = flask.Flask(__name__)
@@ -21,255 +89,535 @@ app = flask.Flask(__name__)
 #: Url format for HTTP api requests to recreation.gov for a given campsite id.
 CAMPGROUND_URL = "https://www.recreation.gov/camping/campgrounds/{id}"
 
-#: Maps known general general camping areas to reserve-america-scraper
-#: campground names.
-CAMPGROUNDS = [
-    {
-        "short_name": "Upper Pines",
-        "name": "UPPER_PINES",
-        "id": "232447",
-        "tags": ["yosemite-valley", "yosemite"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Lower Pines",
-        "name": "LOWER_PINES",
-        "id": "232450",
-        "tags": ["yosemite-valley", "yosemite"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "North Pines",
-        "name": "NORTH_PINES",
-        "id": "232449",
-        "tags": ["yosemite-valley", "yosemite"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Dry Gulch",
-        "name": "DRY_GULCH",
-        "id": "233842",
-        "tags": ["yosemite"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Tuolumne Meadows",
-        "name": "TUOLOUMME",
-        "id": "232448",
-        "tags": ["yosemite", "tuolumne"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Crane Flat",
-        "name": "CRANE_FLAT",
-        "id": "232452",
-        "tags": ["yosemite"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Hodgdon Meadow",
-        "name": "HODGDON_MEADOW",
-        "id": "232451",
-        "tags": ["yosemite"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Dirt Flat",
-        "name": "DIRT_FLAT",
-        "id": "233839",
-        "tags": ["yosemite"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Tuolumne Meadows",
-        "name": "TOULUMNE_MEADOWS",
-        "id": "232448",
-        "tags": ["yosemite", "tuolumne"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Kalaloch",
-        "name": "KALALOCH",
-        "id": "232464",
-        "tags": ["mt-olympic"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Sol Duc",
-        "name": "SOL_DUC",
-        "id": "251906",
-        "tags": ["mt-olympic"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Point Reyes National Seashore",
-        "name": "POINT_REYES",
-        "id": "233359",
-        "tags": ["point-reyes"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Cottonwood",
-        "name": "COTTONWOOD",
-        "id": "272299",
-        "tags": ["jtree"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Jumbo Rocks",
-        "name": "JUMBO_ROCKS",
-        "id": "272300",
-        "tags": ["jtree"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Indian Cove",
-        "name": "INDIAN_COVE",
-        "id": "232472",
-        "tags": ["jtree"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "Black Rock",
-        "name": "BLACK_ROCK",
-        "id": "232473",
-        "tags": ["jtree"],
-        "tz": "US/Pacific",
-    },
-    {
-        "short_name": "St. Mary",
-        "name": "ST_MARY",
-        "id": "232492",
-        "tags": ["gnp"],
-        "tz": "US/Mountain",
-    },
-    {
-        "short_name": "Fish Creek",
-        "name": "FISH_CREEK",
-        "id": "232493",
-        "tags": ["gnp"],
-        "tz": "US/Mountain",
-    },
-    {
-        "short_name": "Many Glacier",
-        "name": "MANY_GLACIER",
-        "id": "251869",
-        "tags": ["gnp"],
-        "tz": "US/Mountain",
-    },
-    {
-        "short_name": "Colter Bay",
-        "name": "COLTER_BAY",
-        "id": "258830",
-        "tags": ["teton"],
-        "tz": "US/Mountain",
-    },
-    {
-        "short_name": "Jenny Lake",
-        "name": "JENNY_LAKE",
-        "id": "247664",
-        "tags": ["teton"],
-        "tz": "US/Mountain",
-    },
-    {
-        "short_name": "South Campground",
-        "name": "SOUTH_CAMPGROUND",
-        "id": "272266",
-        "tags": ["zion"],
-        "tz": "US/Central",
-    },
-    {
-        "short_name": "Watchman Campground",
-        "name": "WATCHMAN_CAMPGROUND",
-        "id": "232445",
-        "tags": ["zion"],
-        "tz": "US/Central",
-    },
-]
-#: Known campground tags formed via a superset of all tags in the CAMPGROUNDS
-#: collection defined above. CAMPGROUNDS is the authoriative source for this
-#: data.
-CAMPGROUND_TAGS = list(set(itertools.chain.from_iterable([cg['tags'] for cg in CAMPGROUNDS])))
+#: Json file listing the known general camping areas, see `Catalog`.
+CAMPGROUNDS_PATH = os.getenv(
+    'CRUSHER_CAMPGROUNDS_PATH',
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'campgrounds.json'),
+)
+#: How often, at most, to check whether the campgrounds file has changed.
+CAMPGROUNDS_RELOAD_SECONDS = float(os.getenv('CRUSHER_CAMPGROUNDS_RELOAD_SECONDS', '30'))
 #: The API token for the slack bot can be obtained via:
 #: https://api.slack.com/apps/AD3G033C4/oauth?
 SLACK_API_KEY = os.getenv('SLACK_API_KEY')
 #: Shared secret used to sign requests.
 SLACK_SIGNING_SECRET = os.getenv('SLACK_SIGNING_SECRET')
+#: Number of threads posting messages to slack in each server process.
+SLACK_THREADS = int(os.getenv('CRUSHER_SLACK_THREADS', '2'))
+#: Minimum time between messages to the same slack channel. Slack allows
+#: roughly one message per second per channel. This is enforced per server
+#: process, so with n gunicorn workers set it to n seconds to stay within
+#: slack's limit; rate limited posts are retried regardless.
+SLACK_CHANNEL_INTERVAL_SECONDS = float(os.getenv('CRUSHER_SLACK_CHANNEL_INTERVAL_SECONDS', '1'))
 #: In addition to @messaging the user that registered the watcher,
 #: the bot will also messsage this public channel.
 PUBLIC_RESULTS_CHANNEL = "campsites"
 #: This should match the name of the application, using a different name
 #: is a from of masquerading and may require additional permissions.
 BOT_NAME = "CrusherScrape"
-#: The path to the watcher database.
+#: Number of watchers shown per page by `/crush list`.
+LIST_PAGE_SIZE = int(os.getenv('CRUSHER_LIST_PAGE_SIZE', '20'))
+#: The path to the legacy shelve watcher database, migrated on startup.
 REPO_PATH = os.getenv('CRUSHER_REPO_PATH', '/tmp/crusher.db')
+#: The path to the SQLite watcher database.
+DB_PATH = os.getenv('CRUSHER_DB_PATH', '/tmp/crusher.sqlite3')
+#: Number of shards the campgrounds are split into for leasing to workers.
+#: This caps the number of workers that can usefully share the load.
+LEASE_SHARDS = int(os.getenv('CRUSHER_LEASE_SHARDS', '16'))
+
+REQUEST_SECONDS = Histogram(
+    'crusher_http_request_seconds',
+    'Time spent handling api requests.',
+    ['endpoint', 'method', 'status'],
+)
+REPO_SECONDS = Histogram(
+    'crusher_repo_seconds',
+    'Latency of watcher and lease store operations.',
+    ['operation'],
+)
+RESULTS_RECEIVED = Counter(
+    'crusher_results_received_total',
+    'Watcher results received from workers by outcome.',
+    ['outcome'],
+)
+SLACK_MESSAGES = Counter(
+    'crusher_slack_messages_total',
+    'Slack messages sent by outcome.',
+    ['outcome'],
+)
+
+
+def timed(operation):
+    """
+    Decorates a store method to record its latency in REPO_SECONDS.
+    """
+    return REPO_SECONDS.labels(operation).time()
 
 
-class WatchersRepo(object):
+class SQLiteRepo(object):
     """
-    Ghetto jank interface around our mega-lame disk-based database. We store
-    reservations as list instead of a dict because the assumption is this thing
-    will not get very large - in fact we'll probably enforce it - and it
-    seemed appropriate that contents should be ordered.
+    Base class for our SQLite backed stores.
+
+    The database runs in WAL mode so that readers don't block the writer, and
+    every write happens in an immediate transaction so that multiple server
+    processes can share the same file. Connections are kept per thread and
+    are never reused across a fork.
     """
-    KEY = 'watchers'
+    SCHEMA = ""
 
     def __init__(self, path):
         self.path = path
-
-    def _set(self, data):
-        s = shelve.open(self.path, writeback=True)
+        self.local = threading.local()
+
+    @property
+    def conn(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None or self.local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(self.SCHEMA)
+            self.local.conn = conn
+            self.local.pid = os.getpid()
+            self._upgrade()
+        return conn
+
+    def _upgrade(self):
+        pass
+
+    @contextlib.contextmanager
+    def transaction(self, mode='IMMEDIATE'):
+        """
+        :param mode: `IMMEDIATE` to take the write lock up front, or
+            `DEFERRED` for a read-only snapshot.
+        """
+        conn = self.conn
+        conn.execute('BEGIN {}'.format(mode))
         try:
-            s[self.KEY] = data
-        finally:
-            s.close()
+            yield conn
+        except:
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+
+class WatchersRepo(SQLiteRepo):
+    """
+    SQLite backed store of watcher registrations. Each watcher is a row keyed
+    by its id with the full watcher kept as a json document, alongside indexed
+    copies of the fields we look watchers up by. Rows are returned in the order
+    they were registered.
+
+    Every write stamps the rows it touches with a new revision, and removals
+    leave a tombstone behind, so that clients can ask for just the watchers
+    that changed since the last revision they saw, see `changes`.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS watchers (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT NOT NULL UNIQUE,
+            user_id TEXT,
+            campground TEXT,
+            data TEXT NOT NULL,
+            revision INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS watchers_user_id ON watchers (user_id);
+        CREATE INDEX IF NOT EXISTS watchers_campground ON watchers (campground);
+        CREATE TABLE IF NOT EXISTS tombstones (
+            id TEXT PRIMARY KEY,
+            revision INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS tombstones_revision ON tombstones (revision);
+        CREATE TABLE IF NOT EXISTS meta (
+            key TEXT PRIMARY KEY,
+            value INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO meta (key, value) VALUES ('revision', 1);
+    """
+
+    def _upgrade(self):
+        """
+        Adds revisions to databases created before the change feed existed.
+        Existing rows are all considered part of the first revision.
+        """
+        with self.transaction() as conn:
+            columns = [row[1] for row in conn.execute('PRAGMA table_info(watchers)')]
+            if 'revision' not in columns:
+                conn.execute('ALTER TABLE watchers ADD COLUMN revision INTEGER NOT NULL DEFAULT 1')
+            conn.execute('CREATE INDEX IF NOT EXISTS watchers_revision ON watchers (revision)')
+
+    def _row(self, watcher, revision):
+        return (
+            watcher['id'],
+            watcher.get('user_id'),
+            watcher.get('campground'),
+            json.dumps(watcher),
+            revision,
+        )
 
-    def list(self):
-        s = shelve.open(self.path)
+    def _next_revision(self, conn):
+        conn.execute("UPDATE meta SET value = value + 1 WHERE key = 'revision'")
+        return conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+
+    def _where(self, user_id=None, campground=None, start=None):
+        clauses = []
+        params = []
+        if user_id is not None:
+            clauses.append('user_id = ?')
+            params.append(user_id)
+        if campground is not None:
+            clauses.append('campground = ?')
+            params.append(campground)
+        if start is not None:
+            clauses.append('seq >= ?')
+            params.append(start)
+        where = 'WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return where, params
+
+    @timed('list')
+    def list(self, user_id=None, campground=None):
+        where, params = self._where(user_id, campground)
+        rows = self.conn.execute(
+            'SELECT data FROM watchers {} ORDER BY seq'.format(where),
+            params,
+        )
+        return [json.loads(data) for data, in rows]
+
+    def iterate(self, user_id=None, campground=None, start=None, limit=None):
+        """
+        Yields watchers one at a time in the order they were registered,
+        starting from the `start` cursor and stopping after `limit` watchers.
+
+        Rows are read off the cursor as they are consumed, so memory use
+        doesn't grow with the number of watchers.
+        """
+        where, params = self._where(user_id, campground, start)
+        cursor = self.conn.execute(
+            'SELECT data FROM watchers {} ORDER BY seq LIMIT ?'.format(where),
+            params + [-1 if limit is None else limit],
+        )
         try:
-            watchers = s[self.KEY]
-        except KeyError:
-            return []
+            for data, in cursor:
+                yield json.loads(data)
         finally:
-            s.close()
-        return watchers
-
+            # Let go of the read snapshot if the caller stops early.
+            cursor.close()
+
+    def cursor_after(self, user_id=None, campground=None, start=None, limit=None):
+        """
+        Returns the cursor of the page following the `limit` watchers from
+        `start`, or None when there are no more watchers.
+        """
+        if limit is None:
+            return None
+        where, params = self._where(user_id, campground, start)
+        row = self.conn.execute(
+            'SELECT seq FROM watchers {} ORDER BY seq LIMIT 1 OFFSET ?'.format(where),
+            params + [limit],
+        ).fetchone()
+        return row[0] if row else None
+
+    @timed('count')
+    def count(self):
+        return self.conn.execute('SELECT COUNT(*) FROM watchers').fetchone()[0]
+
+    @timed('remove')
     def remove(self, watcher_id):
-        watchers = [x for x in self.list() if x['id'] != watcher_id]
-        self._set(watchers)
-        return watchers
-
+        with self.transaction() as conn:
+            deleted = conn.execute('DELETE FROM watchers WHERE id = ?', (watcher_id,))
+            if deleted.rowcount:
+                conn.execute(
+                    'INSERT OR REPLACE INTO tombstones (id, revision) VALUES (?, ?)',
+                    (watcher_id, self._next_revision(conn)),
+                )
+        return self.list()
+
+    @timed('page')
+    def page(self, user_id=None, offset=0, limit=-1):
+        """
+        Returns a page of watchers in the order they were registered.
+
+        :returns: A tuple of `(watchers, total)` where `watchers` is a list of
+            `(watcher, revision)` tuples and `total` counts every matching
+            watcher.
+        """
+        where, params = self._where(user_id)
+        with self.transaction('DEFERRED') as conn:
+            total = conn.execute(
+                'SELECT COUNT(*) FROM watchers {}'.format(where),
+                params,
+            ).fetchone()[0]
+            rows = conn.execute(
+                'SELECT data, revision FROM watchers {} ORDER BY seq LIMIT ? OFFSET ?'.format(where),
+                params + [limit, offset],
+            ).fetchall()
+        return [(json.loads(data), revision) for data, revision in rows], total
+
+    @timed('get')
     def get(self, watcher_id):
-        watchers = [x for x in self.list() if x['id'] == watcher_id]
-        if len(watchers) > 0:
-            return watchers[0]
+        row = self.conn.execute(
+            'SELECT data FROM watchers WHERE id = ?',
+            (watcher_id,),
+        ).fetchone()
+        if row:
+            return json.loads(row[0])
         else:
             return None
 
+    def _get_many(self, conn, watcher_ids):
+        watchers = {}
+        # Stay under SQLite's default limit on the number of query parameters.
+        for i in range(0, len(watcher_ids), 500):
+            chunk = watcher_ids[i:i + 500]
+            rows = conn.execute(
+                'SELECT data FROM watchers WHERE id IN ({})'.format(', '.join('?' * len(chunk))),
+                chunk,
+            )
+            for data, in rows:
+                watcher = json.loads(data)
+                watchers[watcher['id']] = watcher
+        return watchers
+
+    def _update_many(self, conn, watchers):
+        revision = self._next_revision(conn)
+        conn.executemany(
+            'UPDATE watchers SET user_id = ?, campground = ?, data = ?, revision = ? WHERE id = ?',
+            [
+                (user_id, campground, data, revision, watcher_id)
+                for watcher_id, user_id, campground, data, revision
+                in (self._row(watcher, revision) for watcher in watchers)
+            ],
+        )
+
+    @timed('get_many')
+    def get_many(self, watcher_ids):
+        """
+        Returns a dict of watcher id to watcher for the ids that exist.
+        """
+        return self._get_many(self.conn, watcher_ids)
+
     def update(self, watcher):
-        watchers = self.list()
-        for i, w in enumerate(watchers):
-            if w['id'] == watcher['id']:
-                watchers[i] = watcher
-                break
-        self._set(watchers)
+        self.update_many([watcher])
+
+    @timed('update_many')
+    def update_many(self, watchers):
+        if not watchers:
+            return
+        with self.transaction() as conn:
+            self._update_many(conn, watchers)
+
+    @timed('modify_many')
+    def modify_many(self, watcher_ids, modify):
+        """
+        Applies `modify` to each of the watchers that exist, reading and
+        writing them under a single write lock so that changes made by other
+        server processes in between can't be lost. Only the watchers `modify`
+        returns true for are written.
+
+        :returns: A dict of watcher id to watcher for the ids that exist.
+        """
+        with self.transaction() as conn:
+            watchers = self._get_many(conn, watcher_ids)
+            modified = [watcher for watcher in watchers.values() if modify(watcher)]
+            if modified:
+                self._update_many(conn, modified)
+        return watchers
+
+    def set_silenced(self, watcher_id, silenced):
+        """
+        :returns: The updated watcher, or None if it doesn't exist.
+        """
+        def silence(watcher):
+            watcher['silenced'] = silenced
+            return True
+        return self.modify_many([watcher_id], silence).get(watcher_id)
 
+    @timed('append')
     def append(self, watcher):
-        watchers = self.list()
-        watchers.append(watcher)
-        self._set(watchers)
+        with self.transaction() as conn:
+            conn.execute(
+                'INSERT INTO watchers (id, user_id, campground, data, revision) VALUES (?, ?, ?, ?, ?)',
+                self._row(watcher, self._next_revision(conn)),
+            )
+
+    @timed('changes')
+    def changes(self, since):
+        """
+        Returns the watchers added, modified or removed after revision `since`.
+
+        :returns: A tuple of `(revision, watchers, removed_ids)` where
+            `revision` is the revision to ask for changes since next time.
+        """
+        with self.transaction('DEFERRED') as conn:
+            revision = conn.execute("SELECT value FROM meta WHERE key = 'revision'").fetchone()[0]
+            watchers = [
+                json.loads(data)
+                for data, in conn.execute(
+                    'SELECT data FROM watchers WHERE revision > ? ORDER BY seq',
+                    (since,),
+                )
+            ]
+            removed = [
+                watcher_id
+                for watcher_id, in conn.execute(
+                    'SELECT id FROM tombstones WHERE revision > ?',
+                    (since,),
+                )
+            ]
+        return revision, watchers, removed
+
+    def migrate_shelve(self, path):
+        """
+        Imports watchers from the shelve database we used to store them in.
+        Completion is recorded in `meta`, so it's safe to run on every
+        startup and watchers deleted since won't come back.
+        """
+        if not dbm.whichdb(path):
+            return
+        with self.transaction() as conn:
+            if conn.execute("SELECT 1 FROM meta WHERE key = 'shelve_migrated'").fetchone():
+                return
+            conn.execute("INSERT INTO meta (key, value) VALUES ('shelve_migrated', 1)")
+            # Databases migrated before completion was recorded already have
+            # watchers, or tombstones for them.
+            if (conn.execute('SELECT 1 FROM watchers LIMIT 1').fetchone() or
+                    conn.execute('SELECT 1 FROM tombstones LIMIT 1').fetchone()):
+                return
+            s = shelve.open(path, flag='r')
+            try:
+                watchers = s.get('watchers', [])
+            finally:
+                s.close()
+            revision = self._next_revision(conn)
+            conn.executemany(
+                'INSERT OR IGNORE INTO watchers (id, user_id, campground, data, revision) VALUES (?, ?, ?, ?, ?)',
+                [self._row(watcher, revision) for watcher in watchers],
+            )
+        LOGGER.info("migrated %d watchers from %s", len(watchers), path)
+
+
+class LeasesRepo(SQLiteRepo):
+    """
+    Hands out time-limited leases on shards of the campgrounds to workers so
+    that several workers can split the polling work between them. Workers
+    assign a campground to the shard its id hashes to, so each campground's
+    months are fetched by one worker however many tags include it. A watcher
+    spanning several shards is evaluated by each of their workers, each
+    reporting results for its own campgrounds, see `merge_results`.
+
+    Workers call `claim` at the start of every cycle, and periodically while
+    processing it, to renew the leases they hold. Each live worker is given a
+    fair share of the shards; a worker holding more than its share gives the
+    excess back so that new workers can pick them up, and the shards of a
+    worker that stops renewing are reassigned once its leases expire.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS leases (
+            shard INTEGER PRIMARY KEY,
+            holder TEXT,
+            expires REAL NOT NULL DEFAULT 0
+        );
+        CREATE TABLE IF NOT EXISTS lease_workers (
+            worker TEXT PRIMARY KEY,
+            expires REAL NOT NULL
+        );
+    """
+
+    def __init__(self, path, shards):
+        super(LeasesRepo, self).__init__(path)
+        self.shards = shards
+
+    @timed('claim_leases')
+    def claim(self, worker, ttl):
+        """
+        :returns: The sorted list of shards leased to `worker`.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany(
+                'INSERT OR IGNORE INTO leases (shard) VALUES (?)',
+                [(shard,) for shard in range(self.shards)],
+            )
+            conn.execute(
+                'INSERT OR REPLACE INTO lease_workers (worker, expires) VALUES (?, ?)',
+                (worker, now + ttl),
+            )
+            conn.execute('DELETE FROM lease_workers WHERE expires <= ?', (now,))
+            live = conn.execute('SELECT COUNT(*) FROM lease_workers').fetchone()[0]
+            share = -(-self.shards // live)
+
+            leases = conn.execute(
+                'SELECT shard, holder, expires FROM leases WHERE shard < ?',
+                (self.shards,),
+            ).fetchall()
+
+            mine = [shard for shard, holder, expires in leases if holder == worker and expires > now]
+            free = [shard for shard, holder, expires in leases if expires <= now]
+            released = mine[share:]
+            mine = mine[:share] + free[:max(0, share - len(mine))]
+
+            conn.executemany(
+                'UPDATE leases SET holder = NULL, expires = 0 WHERE shard = ?',
+                [(shard,) for shard in released],
+            )
+            conn.executemany(
+                'UPDATE leases SET holder = ?, expires = ? WHERE shard = ?',
+                [(worker, now + ttl, shard) for shard in mine],
+            )
+        return sorted(mine)
+
+    @timed('release_leases')
+    def release(self, worker):
+        with self.transaction() as conn:
+            conn.execute('DELETE FROM lease_workers WHERE worker = ?', (worker,))
+            conn.execute(
+                'UPDATE leases SET holder = NULL, expires = 0 WHERE holder = ?',
+                (worker,),
+            )
 
 
 #: Global disk-based database of watcher registrations.
-WATCHERS = WatchersRepo(REPO_PATH)
+WATCHERS = WatchersRepo(DB_PATH)
+WATCHERS.migrate_shelve(REPO_PATH)
+#: Work assignments for the worker fleet.
+LEASES = LeasesRepo(DB_PATH, LEASE_SHARDS)
+
+
+class WatchersCollector(object):
+    """
+    Reports the number of registered watchers whenever metrics are scraped.
+    """
+
+    def collect(self):
+        watchers = GaugeMetricFamily('crusher_watchers', 'Registered watchers.')
+        watchers.add_metric([], WATCHERS.count())
+        yield watchers
+
+
+def make_metrics_registry():
+    """
+    Returns the registry served by `/metrics`. When running under gunicorn
+    every process records metrics in PROMETHEUS_MULTIPROC_DIR, see
+    gunicorn.conf.py, and a scrape of any process adds them all up.
+    """
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    registry.register(WatchersCollector())
+    return registry
+
+
+METRICS = make_metrics_registry()
 
 
 def random_id():
     return humanhash.humanize(hashlib.md5(os.urandom(32)).hexdigest())
 
 
-def make_watcher(user_id, campground, start, length):
-    return {
+def make_watcher(user_id, campground, start, length, constraints=None):
+    watcher = {
         "id": random_id(),
         "user_id": user_id,
         "campground": campground,
@@ -277,14 +625,103 @@ def make_watcher(user_id, campground, start, length):
         "length": length,
         "silenced": False,
     }
+    if constraints:
+        watcher['constraints'] = constraints
+    return watcher
 
 
-def add_watcher(user_id, campground, start, length):
-    if campground not in CAMPGROUND_TAGS:
+def parse_date(value):
+    """
+    Returns the arrow date for a DD/MM/YY `value`, or None if it isn't one.
+    """
+    try:
+        date = arrow.get(value, 'DD/MM/YY')
+    except:
+        return None
+    # Hackish workaround: 01/01/2019 successfully parses via DD/MM/YY above,
+    # but will subsequently get interpretted as e.g. "2020" - ignoring the
+    # latter two characters.
+    if date.format('DD/MM/YY') != value:
+        return None
+    return date
+
+
+def parse_constraints(options, start, length):
+    """
+    Parses the optional `key=value` arguments of `/crush watch` into the
+    constraints the worker applies while evaluating a watcher:
+
+    - `until`: makes the watcher flexible, looking for a stay arriving on any
+      day from its start date up to and including this DD/MM/YY date.
+    - `min`: the smallest fraction of the stay a site must be available for,
+      either as a fraction or a percentage, e.g. `min=0.5` or `min=50%`.
+    - `nights`: the number of consecutive nights a site must be available.
+    - `loops`, `sites`: comma separated lists of the only loops or sites to
+      consider. Names are matched ignoring case and surrounding whitespace,
+      and names with spaces can be quoted, e.g. `loops="UPPER PINES,NORTH"`.
+    - `top`: the most sites to report.
+
+    :raises ValueError: With a message for the user if an option is invalid.
+    """
+    constraints = {}
+    for option in options:
+        key, sep, value = option.partition('=')
+        if not sep or not value:
+            raise ValueError("Options look like `key=value`, got `{}`.".format(option))
+        if key not in ('until', 'min', 'nights', 'loops', 'sites', 'top'):
+            raise ValueError("Unknown option `{}`, use one of until, min, nights, loops, sites or top.".format(key))
+        try:
+            if key == 'until':
+                until = parse_date(value)
+                if until is None or until < start:
+                    raise ValueError
+                constraints['until'] = value
+            elif key == 'min':
+                fraction = float(value[:-1]) / 100 if value.endswith('%') else float(value)
+                if not 0 < fraction <= 1:
+                    raise ValueError
+                constraints['min_fraction'] = fraction
+            elif key == 'nights':
+                nights = int(value)
+                if not 1 <= nights <= length:
+                    raise ValueError
+                constraints['nights'] = nights
+            elif key in ('loops', 'sites'):
+                constraints[key] = [item.strip() for item in value.split(',') if item.strip()]
+            elif key == 'top':
+                top = int(value)
+                if top < 1:
+                    raise ValueError
+                constraints['top'] = top
+        except ValueError:
+            raise ValueError("Invalid value for `{}`: `{}`.".format(key, value))
+    return constraints
+
+
+def describe_constraints(constraints):
+    parts = []
+    if 'until' in constraints:
+        parts.append("arriving as late as {}".format(constraints['until']))
+    if 'min_fraction' in constraints:
+        parts.append("at least {:.0%} of the stay".format(constraints['min_fraction']))
+    if 'nights' in constraints:
+        parts.append("{} night(s) in a row".format(constraints['nights']))
+    if 'loops' in constraints:
+        parts.append("loops {}".format(', '.join(constraints['loops'])))
+    if 'sites' in constraints:
+        parts.append("sites {}".format(', '.join(constraints['sites'])))
+    if 'top' in constraints:
+        parts.append("best {} site(s)".format(constraints['top']))
+    return '; '.join(parts)
+
+
+def add_watcher(user_id, campground, start, length, constraints=None):
+    catalog = CATALOG.get()
+    if campground not in catalog.by_tag:
         return flask.jsonify({
             "response_type": "ephemeral",
             "text": "Unknown camping area, please select one of {}".format(
-                ', '.join(CAMPGROUND_TAGS),
+                ', '.join(catalog.tags),
             )
         })
 
@@ -293,6 +730,7 @@ def add_watcher(user_id, campground, start, length):
         campground,
         start,
         length,
+        constraints,
     ))
 
     return flask.jsonify({
@@ -303,19 +741,158 @@ def add_watcher(user_id, campground, start, length):
     })
 
 
+@app.before_request
+def start_request_timer():
+    flask.g.request_started = time.monotonic()
+
+
+@app.after_request
+def observe_request(response):
+    started = getattr(flask.g, 'request_started', None)
+    if started is not None:
+        REQUEST_SECONDS.labels(
+            flask.request.endpoint or 'unknown',
+            flask.request.method,
+            response.status_code,
+        ).observe(time.monotonic() - started)
+    return response
+
+
+@app.route('/metrics')
+def metrics():
+    return flask.Response(
+        prometheus_client.generate_latest(METRICS),
+        mimetype=prometheus_client.CONTENT_TYPE_LATEST,
+    )
+
+
 @app.route('/meta/campgrounds')
 def meta_campgrounds():
-    return flask.jsonify(CAMPGROUNDS)
+    catalog = CATALOG.get()
+    resp = flask.jsonify(catalog.campgrounds)
+    resp.set_etag(catalog.version)
+    return resp.make_conditional(flask.request)
+
+
+@app.route('/meta/campgrounds/<campground_id>')
+def meta_campground(campground_id):
+    catalog = CATALOG.get()
+    if campground_id not in catalog.by_id:
+        flask.abort(404)
+    resp = flask.jsonify(catalog.by_id[campground_id])
+    resp.set_etag(catalog.version)
+    return resp.make_conditional(flask.request)
 
 
 @app.route('/meta/tags')
 def meta_campground_tags():
-    return flask.jsonify(CAMPGROUND_TAGS)
+    catalog = CATALOG.get()
+    resp = flask.jsonify(catalog.tags)
+    resp.set_etag(catalog.version)
+    return resp.make_conditional(flask.request)
+
+
+@app.route('/leases/claim', methods=['POST'])
+def leases_claim():
+    """
+    Claims or renews a worker's leases. The request body is a json object with
+    the `worker` id and the lease `ttl` in seconds. Responds with the `shards`
+    now leased to the worker and the total `shard_count`.
+    """
+    body = flask.request.get_json()
+    shards = LEASES.claim(body['worker'], float(body['ttl']))
+    return flask.jsonify({
+        "shards": shards,
+        "shard_count": LEASES.shards,
+    })
+
+
+@app.route('/leases/release', methods=['POST'])
+def leases_release():
+    LEASES.release(flask.request.get_json()['worker'])
+    return flask.jsonify({})
+
+
+def project_watcher(watcher, fields):
+    if fields is None:
+        return watcher
+    return {k: watcher[k] for k in fields if k in watcher}
 
 
 @app.route('/watchers')
 def watchers_list():
-    return flask.jsonify(WATCHERS.list())
+    """
+    Streams watchers in the order they were registered.
+
+    Filter with `user_id` and `campground`, and pass `fields` as a comma
+    separated list of keys to leave the rest of each watcher out, e.g.
+    `fields=id,start,length,campground`. With `limit`, only that many watchers
+    are returned and the `Link` header points at the next page, which is
+    requested by passing its `cursor`. Pass `format=ndjson` to get one json
+    watcher per line instead of a json array.
+    """
+    args = flask.request.args
+    user_id = args.get('user_id')
+    campground = args.get('campground')
+    fields = args.get('fields')
+    fields = [field for field in fields.split(',') if field] if fields else None
+    start = args.get('cursor', type=int)
+    limit = args.get('limit', type=int)
+    if limit is not None and limit < 1:
+        flask.abort(400)
+    ndjson = args.get('format') == 'ndjson'
+
+    watchers = WATCHERS.iterate(user_id, campground, start, limit)
+
+    def generate():
+        try:
+            if ndjson:
+                for watcher in watchers:
+                    yield json.dumps(project_watcher(watcher, fields)) + '\n'
+                return
+            separator = '['
+            for watcher in watchers:
+                yield separator + json.dumps(project_watcher(watcher, fields))
+                separator = ','
+            yield '[]' if separator == '[' else ']'
+        finally:
+            watchers.close()
+
+    response = flask.Response(
+        generate(),
+        mimetype='application/x-ndjson' if ndjson else 'application/json',
+    )
+    cursor = WATCHERS.cursor_after(user_id, campground, start, limit)
+    if cursor is not None:
+        query = args.to_dict()
+        query['cursor'] = cursor
+        response.headers['Link'] = '<{}>; rel="next"'.format(
+            flask.url_for('watchers_list', _external=True, **query),
+        )
+    return response
+
+
+@app.route('/watchers/changes')
+def watchers_changes():
+    """
+    A change feed of watchers added, modified or removed after the `since`
+    revision. Pass `slim=1` to leave out each watcher's stored results.
+
+    Responds with the `revision` to pass as `since` next time, the changed
+    `watchers` and the ids of `removed` watchers.
+    """
+    since = flask.request.args.get('since', 0, type=int)
+    revision, watchers, removed = WATCHERS.changes(since)
+    if flask.request.args.get('slim'):
+        watchers = [
+            {k: v for k, v in watcher.items() if k != 'results'}
+            for watcher in watchers
+        ]
+    return flask.jsonify({
+        "revision": revision,
+        "watchers": watchers,
+        "removed": removed,
+    })
 
 
 @app.route('/watchers/<watcher_id>')
@@ -328,44 +905,302 @@ def watchers_delete(watcher_id):
     return flask.jsonify(WATCHERS.remove(watcher_id))
 
 
-def results_changed(old, new):
-    # Hackish way to compare two lists.
-    return json.dumps(old) != json.dumps(new)
+def result_site(result, flexible=False):
+    """
+    Identifies a reported site. Flexible watchers report each site with its
+    best arrival date, so there the date is part of what was reported.
+    """
+    site = (result['campground']['id'], result['campsite']['site'])
+    return site + (result['date'],) if flexible else site
 
 
-@app.route('/watchers/<watcher_id>/results', methods=['POST'])
-def watchers_results(watcher_id):
-    watcher = WATCHERS.get(watcher_id)
+def results_fingerprint(results, flexible=False):
+    """
+    A stable digest of a result set, independent of the order the sites were
+    reported in.
+    """
+    normalized = sorted(result_site(result, flexible) + (result['fraction'],) for result in results)
+    return hashlib.sha1(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+
+def new_results(old, new, flexible=False):
+    """
+    Returns the results in `new` for sites that weren't in `old`, or whose
+    availability has grown since, like a partial stay opening up in full.
+    """
+    old_fractions = {result_site(result, flexible): result['fraction'] for result in old}
+    return [
+        result for result in new
+        if result['fraction'] > old_fractions.get(result_site(result, flexible), 0)
+    ]
+
+
+def merge_results(watcher, results, campgrounds):
+    """
+    Workers each evaluate a watcher against the campgrounds they hold leases
+    for, so a report only replaces the stored results for `campgrounds`.
+    Results for campgrounds no longer under the watcher's tag are dropped.
+
+    Each worker applies the watcher's `top` constraint to its own share, so
+    the merged results aren't trimmed again: a site dropped here wouldn't be
+    reported again when a better one disappears.
+    """
+    tagged = {cg['id'] for cg in CATALOG.get().by_tag.get(watcher['campground'], [])}
+    reported = set(campgrounds)
+    merged = [
+        result for result in watcher.get('results', [])
+        if result['campground']['id'] in tagged and result['campground']['id'] not in reported
+    ]
+    merged.extend(results)
+    merged.sort(key=lambda result: result['fraction'], reverse=True)
+    return merged
+
+
+def apply_results(watcher, results):
+    """
+    Stores new results on a watcher.
+
+    :returns: A tuple of `(changed, added)` where `changed` is whether the
+        results differ from the ones previously stored and `added` are the
+        results for newly available sites.
+    """
+    flexible = 'until' in (watcher.get('constraints') or {})
     old_results = watcher.get('results', [])
+    old_fingerprint = watcher.get('results_fingerprint') or results_fingerprint(old_results, flexible)
+    fingerprint = results_fingerprint(results, flexible)
+    if fingerprint == old_fingerprint:
+        return False, []
 
-    #: Trusting random input from the internet here.
-    results = flask.request.get_json()
     watcher['results'] = results
-    WATCHERS.update(watcher)
+    watcher['results_fingerprint'] = fingerprint
+    return True, new_results(old_results, results, flexible)
+
+
+def should_notify(watcher, added):
+    return bool(added) and not watcher.get('silenced')
+
 
-    has_changed = results_changed(old_results, results)
-    if len(results) and not watcher.get('silenced') and has_changed:
-        slack = SlackClient(SLACK_API_KEY)
-        resp = slack.api_call(
+class SlackDispatcher(object):
+    """
+    Delivers slack messages from background threads so that handling a
+    request never waits on slack.
+
+    Messages are queued per channel, and a message queued while an earlier one
+    for the same channel is still waiting to go out is merged into it. Each
+    channel is posted to at most once every `channel_interval` seconds, in line
+    with slack's rate limits, and failed posts are retried with backoff. When
+    slack answers `ratelimited` every channel waits out its `Retry-After`
+    before posting again, and the message is retried without using up one of
+    its attempts. All posts share one long-lived client.
+
+    Threads are started on first use, so each server process gets its own, and
+    the per-channel interval only holds within a process.
+    """
+    MAX_ATTEMPTS = 5
+    #: Seconds to back off when slack rate limits us without a Retry-After.
+    RATELIMITED_BACKOFF = 30
+
+    def __init__(self, api_key, threads, channel_interval):
+        self.api_key = api_key
+        self.threads = threads
+        self.channel_interval = channel_interval
+        self.client = None
+        self.cond = threading.Condition()
+        #: Messages waiting to be sent, by channel.
+        self.pending = collections.OrderedDict()
+        #: Channels with a message currently being sent.
+        self.sending = set()
+        #: The earliest time we may post to a channel again.
+        self.next_post = {}
+        #: The earliest time we may post to any channel after being rate
+        #: limited.
+        self.blocked_until = 0
+
+    def post(self, channel, text, attachments, **kwargs):
+        with self.cond:
+            if self.client is None:
+                self.client = SlackClient(self.api_key)
+                for _ in range(self.threads):
+                    threading.Thread(target=self._run, daemon=True).start()
+
+            message = self.pending.get(channel)
+            if message is None:
+                self.pending[channel] = {
+                    'text': text,
+                    'attachments': list(attachments),
+                    'kwargs': kwargs,
+                    'attempts': 0,
+                }
+            else:
+                message['attachments'].extend(attachments)
+            self.cond.notify()
+
+    def _next(self):
+        """
+        Waits for a channel that's ready to be posted to and takes its message.
+        """
+        with self.cond:
+            while True:
+                now = time.time()
+                wait = None
+                for channel in self.pending:
+                    if channel in self.sending:
+                        continue
+                    ready_at = max(self.next_post.get(channel, 0), self.blocked_until)
+                    if ready_at <= now:
+                        self.sending.add(channel)
+                        return channel, self.pending.pop(channel)
+                    wait = ready_at - now if wait is None else min(wait, ready_at - now)
+                self.cond.wait(wait)
+
+    def _run(self):
+        while True:
+            channel, message = self._next()
+            try:
+                ok, retry_after = self._send(channel, message)
+            except Exception:
+                LOGGER.exception("failed to post to slack channel %s", channel)
+                ok, retry_after = False, None
+            SLACK_MESSAGES.labels('ok' if ok else 'error').inc()
+
+            with self.cond:
+                self.sending.discard(channel)
+                delay = self.channel_interval
+                if retry_after:
+                    self.blocked_until = max(self.blocked_until, time.time() + retry_after)
+                if not ok:
+                    if not retry_after:
+                        message['attempts'] += 1
+                    if message['attempts'] < self.MAX_ATTEMPTS:
+                        delay = max(delay, retry_after or 0, 2 ** message['attempts'])
+                        # Put the message back in front of anything queued
+                        # for the channel while we were sending it.
+                        newer = self.pending.pop(channel, None)
+                        if newer is not None:
+                            message['attachments'].extend(newer['attachments'])
+                        self.pending[channel] = message
+                    else:
+                        LOGGER.error("giving up posting to slack channel %s", channel)
+                self.next_post[channel] = time.time() + delay
+                self.cond.notify_all()
+
+    def _send(self, channel, message):
+        """
+        :returns: A tuple of `(ok, retry_after)`, where `retry_after` is only
+            set when slack rate limited us.
+        """
+        resp = self.client.api_call(
             "chat.postMessage",
-            username=BOT_NAME,
-            text="New campsites available!",
-            channel=watcher['user_id'],
-            attachments=make_results_attachments(results),
+            channel=channel,
+            text=message['text'],
+            attachments=message['attachments'],
+            **message['kwargs']
         )
+        if resp.get('ok'):
+            return True, None
+        error = resp.get('error')
+        LOGGER.warning("slack rejected message for %s: %s", channel, error)
+        if error != 'ratelimited':
+            return False, None
+        # slackclient adds the response headers to the body it returns, keeping
+        # whatever case slack sent them in.
+        headers = {name.lower(): value for name, value in (resp.get('headers') or {}).items()}
+        try:
+            return False, float(headers['retry-after'])
+        except (KeyError, TypeError, ValueError):
+            return False, self.RATELIMITED_BACKOFF
+
+
+#: Outbound slack messages.
+DISPATCHER = SlackDispatcher(SLACK_API_KEY, SLACK_THREADS, SLACK_CHANNEL_INTERVAL_SECONDS)
+
+
+def notify_results(watcher, added):
+    DISPATCHER.post(
+        watcher['user_id'],
+        "New campsites available!",
+        make_results_attachments(added),
+        username=BOT_NAME,
+    )
+
+
+@app.route('/watchers/<watcher_id>/results', methods=['POST'])
+def watchers_results(watcher_id):
+    #: Trusting random input from the internet here.
+    results = flask.request.get_json()
+    notify = []
+
+    def store(watcher):
+        changed, added = apply_results(watcher, results)
+        if changed and should_notify(watcher, added):
+            notify.append(added)
+        return changed
+
+    watcher = WATCHERS.modify_many([watcher_id], store).get(watcher_id)
+    for added in notify:
+        notify_results(watcher, added)
     return flask.jsonify(watcher)
 
 
-def slack_list_watchers(user_id=None):
-    watchers = WATCHERS.list()
-    if user_id:
-        watchers = [watcher for watcher in WATCHERS.list() if  watcher['user_id'] == user_id]
+@app.route('/watchers/results:batch', methods=['POST'])
+def watchers_results_batch():
+    """
+    Stores results for many watchers in a single transaction. The request body
+    is a json object of watcher id to either the full list of results, or an
+    object with the ids of the `campgrounds` a worker evaluated and the
+    `results` for just those, see `merge_results`. The response maps each
+    watcher id to `ok`, or `not_found` if the watcher has since been removed.
+
+    Only watchers whose results changed are written, which keeps unchanged
+    watchers out of the change feed.
+    """
+    #: Trusting random input from the internet here.
+    batch = flask.request.get_json()
+
+    statuses = {}
+    notify = []
+
+    def store(watcher):
+        results = batch[watcher['id']]
+        if isinstance(results, dict):
+            results = merge_results(watcher, results['results'], results['campgrounds'])
+        changed, added = apply_results(watcher, results)
+        if changed and should_notify(watcher, added):
+            notify.append((watcher, added))
+        statuses[watcher['id']] = 'ok'
+        RESULTS_RECEIVED.labels('changed' if changed else 'unchanged').inc()
+        return changed
+
+    WATCHERS.modify_many(list(batch), store)
+    for watcher_id in batch:
+        if watcher_id not in statuses:
+            statuses[watcher_id] = 'not_found'
+            RESULTS_RECEIVED.labels('not_found').inc()
+
+    for watcher, added in notify:
+        notify_results(watcher, added)
+    return flask.jsonify(statuses)
+
+
+def slack_list_watchers(user_id=None, page=1):
+    watchers, total = WATCHERS.page(
+        user_id=user_id or None,
+        offset=(page - 1) * LIST_PAGE_SIZE,
+        limit=LIST_PAGE_SIZE,
+    )
 
     if len(watchers):
-        return flask.jsonify({
+        response = {
             "response_type": "in_channel",
-            "attachments": make_watcher_attachments(watchers),
-        })
+            "attachments": [
+                WATCHER_ATTACHMENTS.get(watcher, revision)
+                for watcher, revision in watchers
+            ],
+        }
+        pages = -(-total // LIST_PAGE_SIZE)
+        if pages > 1:
+            response["text"] = "Page {} of {}, add a page number to see more.".format(page, pages)
+        return flask.jsonify(response)
     else:
         return flask.jsonify({
             "response_type": "in_channel",
@@ -373,25 +1208,127 @@ def slack_list_watchers(user_id=None):
         })
 
 
-def slack_list_campgrounds(tags):
-    cgs = []
-    for cg in CAMPGROUNDS:
-        # Check intersection if tags is non-empty.
-        if tags and not set(tags) & set(cg['tags']):
-            continue
-        cgs.append({
-            "fallback": "Campground metadata",
-            "mrkdwn_in": ["text"],
-            "title": cg['short_name'],
-            "title_link": CAMPGROUND_URL.format(id=cg['id']),
-            "fields": [
-                {
-                    "title": "tags",
-                    "value": ", ".join(cg['tags']),
-                    "short": True,
-                },
-            ],
-        })
+def make_campground_attachment(cg):
+    return {
+        "fallback": "Campground metadata",
+        "mrkdwn_in": ["text"],
+        "title": cg['short_name'],
+        "title_link": CAMPGROUND_URL.format(id=cg['id']),
+        "fields": [
+            {
+                "title": "tags",
+                "value": ", ".join(cg['tags']),
+                "short": True,
+            },
+        ],
+    }
+
+
+class Catalog(object):
+    """
+    An immutable, indexed snapshot of the campground catalog.
+
+    Campgrounds listed more than once with the same id are merged into the
+    first entry, with their tags combined, so that every campground is only
+    fetched and evaluated once per watcher. `version` is a digest of the
+    merged catalog served as its ETag so that clients can cache it and only
+    re-download it when it changes.
+    """
+
+    def __init__(self, campgrounds):
+        by_id = collections.OrderedDict()
+        for cg in campgrounds:
+            if cg['id'] in by_id:
+                LOGGER.warning("campground %s (%s) is listed more than once", cg['id'], cg['name'])
+                existing = by_id[cg['id']]
+                existing['tags'] = existing['tags'] + [t for t in cg['tags'] if t not in existing['tags']]
+            else:
+                by_id[cg['id']] = dict(cg)
+
+        #: Campgrounds in the order they are listed.
+        self.campgrounds = list(by_id.values())
+        self.by_id = dict(by_id)
+        self.by_name = {cg['name']: cg for cg in self.campgrounds}
+        by_tag = collections.defaultdict(list)
+        for cg in self.campgrounds:
+            for tag in cg['tags']:
+                by_tag[tag].append(cg)
+        self.by_tag = dict(by_tag)
+        self.tags = sorted(self.by_tag)
+        self.version = hashlib.sha1(json.dumps(self.campgrounds, sort_keys=True).encode('utf-8')).hexdigest()
+        #: Attachments for `/crush campgrounds`, keyed by campground id.
+        self.attachments = {cg['id']: make_campground_attachment(cg) for cg in self.campgrounds}
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def search(self, terms):
+        """
+        Returns the campgrounds matching any of `terms`, each of which may be a
+        tag, a campground id or a campground name, in catalog order.
+        """
+        matched = set()
+        for term in terms:
+            matched.update(cg['id'] for cg in self.by_tag.get(term, []))
+            for index in (self.by_id, self.by_name):
+                if term in index:
+                    matched.add(index[term]['id'])
+        return [cg for cg in self.campgrounds if cg['id'] in matched]
+
+
+class CatalogLoader(object):
+    """
+    Keeps the current `Catalog` loaded from a json file, reloading it when the
+    file changes without needing a restart.
+
+    The file is checked at most once every `interval` seconds when the catalog
+    is asked for. A reload builds a complete new `Catalog` before swapping it
+    in, so readers always see either the old or the new catalog in full. If
+    the changed file can't be read or parsed the previous catalog is kept
+    until the file changes again.
+    """
+
+    def __init__(self, path, interval):
+        self.path = path
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.mtime = os.stat(path).st_mtime
+        self.catalog = Catalog.load(path)
+        self.checked = time.monotonic()
+        LOGGER.info("loaded campground catalog version %s", self.catalog.version)
+
+    def get(self):
+        if time.monotonic() - self.checked >= self.interval:
+            self.reload()
+        return self.catalog
+
+    def reload(self):
+        with self.lock:
+            self.checked = time.monotonic()
+            try:
+                mtime = os.stat(self.path).st_mtime
+                if mtime == self.mtime:
+                    return
+                # Don't retry a broken file until it changes again.
+                self.mtime = mtime
+                catalog = Catalog.load(self.path)
+            except (OSError, ValueError, KeyError, TypeError):
+                LOGGER.exception("failed to reload campgrounds from %s - keeping version %s", self.path, self.catalog.version)
+                return
+            self.catalog = catalog
+            LOGGER.info("reloaded campground catalog version %s", catalog.version)
+
+
+#: The campground catalog, see `CatalogLoader`.
+CATALOG = CatalogLoader(CAMPGROUNDS_PATH, CAMPGROUNDS_RELOAD_SECONDS)
+
+
+def slack_list_campgrounds(terms):
+    catalog = CATALOG.get()
+    campgrounds = catalog.search(terms) if terms else catalog.campgrounds
+    cgs = [catalog.attachments[cg['id']] for cg in campgrounds]
 
     if cgs:
         return flask.jsonify({
@@ -417,6 +1354,7 @@ def slack_actions():
     # Sample payload: see contrib/sample_action_payload.json
     if action['name'] == 'cancel':
         WATCHERS.remove(action['value'])
+        WATCHER_ATTACHMENTS.invalidate(action['value'])
         return slack_list_watchers()
     if action['name'] == 'results':
         watcher = WATCHERS.get(action['value'])
@@ -425,16 +1363,12 @@ def slack_actions():
             "attachments": make_results_attachments(watcher['results']),
         })
     if action['name'] == 'silence':
-        watcher = WATCHERS.get(action['value'])
-        watcher['silenced'] = True
-        WATCHERS.update(watcher)
+        watcher = WATCHERS.set_silenced(action['value'], True)
         return flask.jsonify({
             "text": "Silenced watcher, will no longer message <@{}>!".format(watcher['user_id']),
         })
     if action['name'] == 'unsilence':
-        watcher = WATCHERS.get(action['value'])
-        watcher['silenced'] = False
-        WATCHERS.update(watcher)
+        watcher = WATCHERS.set_silenced(action['value'], False)
         return flask.jsonify({
             "text": "Unsilenced watcher, will now message <@{}> with results!".format(watcher['user_id']),
         })
@@ -442,6 +1376,31 @@ def slack_actions():
         return flask.jsonify({"text":"Sorry, I didn't get that!"})
 
 
+def parse_page(args):
+    try:
+        return max(1, int(args[0]))
+    except (IndexError, ValueError):
+        return 1
+
+
+#: Slack's smart double quotes, mapped back to plain ones.
+SMART_QUOTES = str.maketrans({'\u201c': '"', '\u201d': '"'})
+
+
+def split_command(text):
+    """
+    Splits a slash command's text on whitespace, keeping double quoted values
+    such as `loops="UPPER PINES"` together. Apostrophes are left alone.
+
+    :raises ValueError: If a quote isn't closed.
+    """
+    lexer = shlex.shlex(text.translate(SMART_QUOTES), posix=True)
+    lexer.whitespace_split = True
+    lexer.quotes = '"'
+    lexer.commenters = ''
+    return list(lexer)
+
+
 @app.route('/slack/commands', methods=['POST'])
 def slack_slash_commands():
     """
@@ -449,23 +1408,30 @@ def slack_slash_commands():
 
     Commands:
 
-    /crush watch <campground-tag> <DD/MM/YY> <length>
+    /crush watch <campground-tag> <DD/MM/YY> <length> [options...]
     ------------------------------------------------------
     Registers a new watcher for a reservation. This will begin a periodic
     scraping process against the recreation.gov website. When succesful we'll
     send you a slack message with results.
 
+    Options narrow down which sites are reported, for example
+    `/crush watch tuolumne 01/07/19 3 min=50% nights=2 loops=A,B top=5`. Quote
+    values with spaces, e.g. `loops="UPPER PINES"`. Use
+    `until=DD/MM/YY` to take a stay arriving on any day up to that date, e.g.
+    `/crush watch tuolumne 01/07/19 3 until=31/07/19` for any 3 nights in
+    July. See `parse_constraints` for the full list.
+
     Campgrounds are selected according to `campground-tag` you provide. The bot
     will attempt to find sites within any campground that matches the tag you
     provide.
 
     To list campgrounds and their tags, use the `campgrounds` command.
 
-    /crush list
+    /crush list [page]
     ----------------------
     Lists active watchers for the current user.
 
-    /crush list-all
+    /crush list-all [page]
     ----------------------
     Lists active watchers for all users.
 
@@ -474,6 +1440,7 @@ def slack_slash_commands():
     Lists known campgrounds, optionally filtered by those that match any of the
     provided tags. For example, if you wish to list what the bot considers
     a 'yosemite-valley' campground use `/crush campgrounds yosemite-valley`.
+    Campground ids and names, e.g. `232447` or `UPPER_PINES`, match too.
 
     Syntax:
         - Square brackets, as in `[param]`, denote optional parameters.
@@ -498,38 +1465,44 @@ def slack_slash_commands():
         })
 
     # Request payload mangling and subcommand delegation occurs.
-    parts = text.split(' ')
+    try:
+        parts = split_command(text)
+    except ValueError:
+        return flask.jsonify({
+            "response_type": "ephemeral",
+            "text": "Your command has an unmatched quote.",
+        })
+    if not parts:
+        parts = ['']
     command = parts[0]
     args = parts[1:]
     if command == 'watch':
-        if len(args) != 3:
+        if len(args) < 3:
             return flask.jsonify({
                 "response_type": "ephemeral",
-                "text": "Please use a format like `tuolumne DD/MM/YY <length>`."
+                "text": "Please use a format like `tuolumne DD/MM/YY <length> [options...]`."
             })
-        campground, start, length = args
+        campground, start, length = args[:3]
 
-        try:
-            date = arrow.get(start, 'DD/MM/YY')
-        except:
+        date = parse_date(start)
+        if date is None:
             return flask.jsonify({
                 "response_type": "ephemeral",
                 "text": "Could not parse your date, please use a DD/MM/YY format.",
             })
-        # Hackish workaround: 01/01/2019 successfully parses via DD/MM/YY above,
-        # but will subsequently get interpretted as e.g. "2020" - ignoring the
-        # latter two characters.
-        if date.format('DD/MM/YY') != start:
+        try:
+            constraints = parse_constraints(args[3:], date, int(length))
+        except ValueError as e:
             return flask.jsonify({
                 "response_type": "ephemeral",
-                "text": "Could not parse your date, please use a DD/MM/YY format.",
+                "text": str(e),
             })
         user_id = flask.request.form['user_id']
-        return add_watcher(user_id, campground, start, int(length))
+        return add_watcher(user_id, campground, start, int(length), constraints)
     elif command == 'list':
-        return slack_list_watchers(flask.request.form['user_id'])
+        return slack_list_watchers(flask.request.form['user_id'], parse_page(args))
     elif command == 'list-all':
-        return slack_list_watchers()
+        return slack_list_watchers(page=parse_page(args))
     elif command == 'campgrounds':
         return slack_list_campgrounds(args)
     elif command == 'help':
@@ -544,80 +1517,112 @@ def slack_slash_commands():
         })
 
 
+def make_watcher_attachment(watcher):
+    """
+    Returns a json-encodable representation of an attachment representing an
+    active watcher.
+    """
+    watch_results = watcher.get('results')
+    if watch_results:
+        text = "<@{}> found sites in *{}* from {} for {} day(s).".format(
+            watcher['user_id'],
+            watcher['campground'],
+            watcher['start'],
+            watcher['length'],
+        )
+        color = "#36a64f"
+    else:
+        text = "<@{}> is looking in *{}* from {} for {} day(s).".format(
+            watcher['user_id'],
+            watcher['campground'],
+            watcher['start'],
+            watcher['length'],
+        )
+        color = "#ccbd22"
+    if watcher.get('constraints'):
+        text += "\nOnly {}.".format(describe_constraints(watcher['constraints']))
+
+    attachment = {
+        "fallback": "Required plain-text summary of the attachment.",
+        "color": color,
+        "text": text,
+        "mrkdwn_in": ["text", "pretext"],
+        "callback_id": "watcher_manage",
+        "actions": [
+            {
+                "name": "cancel",
+                "text": "Remove",
+                "style": "danger",
+                "type": "button",
+                "value": watcher['id'],
+                "confirm": {
+                    "title": "Are you sure?",
+                    "text": "This will cancel scraping for this reservation.",
+                    "ok_text": "Yes",
+                    "dismiss_text": "No"
+                },
+            },
+        ]
+    }
+
+    if watcher.get('silenced'):
+        attachment['actions'].insert(0, {
+            "name": "unsilence",
+            "text": "Unsilence",
+            "type": "button",
+            "value": watcher['id'],
+        })
+    else:
+        attachment['actions'].insert(0, {
+            "name": "silence",
+            "text": "Silence",
+            "type": "button",
+            "value": watcher['id'],
+        })
+
+    if watch_results:
+        attachment['actions'].insert(0, {
+            "name": "results",
+            "text": "Show Results",
+            "type": "button",
+            "style": "primary",
+            "value": watcher['id'],
+        })
+
+    return attachment
+
+
 def make_watcher_attachments(watchers):
     """
     Returns a json-encodable representation of attachments representing active watchers.
     """
-    results = []
-    for watcher in watchers:
-        watch_results = watcher.get('results')
-        if watch_results:
-            text = "<@{}> found sites in *{}* from {} for {} day(s).".format(
-                watcher['user_id'],
-                watcher['campground'],
-                watcher['start'],
-                watcher['length'],
-            )
-            color = "#36a64f"
-        else:
-            text = "<@{}> is looking in *{}* from {} for {} day(s).".format(
-                watcher['user_id'],
-                watcher['campground'],
-                watcher['start'],
-                watcher['length'],
-            )
-            color = "#ccbd22"
-
-        attachment = {
-            "fallback": "Required plain-text summary of the attachment.",
-            "color": color,
-            "text": text,
-            "mrkdwn_in": ["text", "pretext"],
-            "callback_id": "watcher_manage",
-            "actions": [
-                {
-                    "name": "cancel",
-                    "text": "Remove",
-                    "style": "danger",
-                    "type": "button",
-                    "value": watcher['id'],
-                    "confirm": {
-                        "title": "Are you sure?",
-                        "text": "This will cancel scraping for this reservation.",
-                        "ok_text": "Yes",
-                        "dismiss_text": "No"
-                    },
-                },
-            ]
-        }
+    return [make_watcher_attachment(watcher) for watcher in watchers]
 
-        if watcher.get('silenced'):
-            attachment['actions'].insert(0, {
-                "name": "unsilence",
-                "text": "Unsilence",
-                "type": "button",
-                "value": watcher['id'],
-            })
-        else:
-            attachment['actions'].insert(0, {
-                "name": "silence",
-                "text": "Silence",
-                "type": "button",
-                "value": watcher['id'],
-            })
 
-        if watch_results:
-            attachment['actions'].insert(0, {
-                "name": "results",
-                "text": "Show Results",
-                "type": "button",
-                "style": "primary",
-                "value": watcher['id'],
-            })
+class WatcherAttachmentCache(object):
+    """
+    Keeps each watcher's attachment around for as long as the watcher stays at
+    the same revision. Revisions come from the database, so updates made by
+    other server processes invalidate entries too.
+    """
+
+    def __init__(self):
+        self.entries = {}
+
+    def get(self, watcher, revision):
+        entry = self.entries.get(watcher['id'])
+        if entry is not None and entry[0] == revision:
+            return entry[1]
+        attachment = make_watcher_attachment(watcher)
+        self.entries[watcher['id']] = (revision, attachment)
+        return attachment
+
+    def invalidate(self, watcher_id):
+        self.entries.pop(watcher_id, None)
 
-        results.append(attachment)
 
-    return results
+#: Attachments for `/crush list`, by watcher id.
+WATCHER_ATTACHMENTS = WatcherAttachmentCache()
 
 
 def make_results_attachments(results):
@@ -657,5 +1662,5 @@ def verify_slack_request(slack_signature=None, slack_request_timestamp=None, req
     if hmac.compare_digest(my_signature, slack_signature):
         return True
     else:
-        LOGGER.warning(f"Verification failed. my_signature: {my_signature} basestring: {basestring}")
+        LOGGER.warning("Verification failed. my_signature: %s basestring: %s", my_signature, basestring)
         return False
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Hammers a running API server with the requests the worker and slack make, and
+reports throughput and latency percentiles.
+
+Start the server one way or the other, e.g. the development server:
+
+    FLASK_APP=app.py python -m flask run
+
+or the production one:
+
+    gunicorn --config gunicorn.conf.py app:app
+
+then run, from the server directory:
+
+    python contrib/loadtest.py --url http://localhost:5000 --clients 32 --seconds 20
+
+The script registers its own watchers directly in the database at
+CRUSHER_DB_PATH, so point it at a scratch database.
+"""
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app  # noqa: E402
+
+
+def make_result(watcher, site):
+    return {
+        "date": watcher['start'],
+        "url": app.CAMPGROUND_URL.format(id='232447'),
+        "campground": {"id": "232447", "short_name": "Upper Pines"},
+        "campsite": {"site": "{:03d}".format(site)},
+        "fraction": 1.0,
+    }
+
+
+def scenarios(base_url, watchers):
+    """
+    The mix of requests each client picks from at random.
+    """
+    def list_changes(session):
+        return session.get(base_url + '/watchers/changes', params={'since': 0, 'slim': 1})
+
+    def campgrounds(session):
+        return session.get(base_url + '/meta/campgrounds')
+
+    def get_watcher(session):
+        return session.get(base_url + '/watchers/' + random.choice(watchers)['id'])
+
+    def post_results(session):
+        # Unchanged results, so we don't flood slack.
+        batch = {
+            watcher['id']: watcher['results']
+            for watcher in random.sample(watchers, min(20, len(watchers)))
+        }
+        return session.post(base_url + '/watchers/results:batch', json=batch)
+
+    return [list_changes, campgrounds, get_watcher, post_results]
+
+
+def client(base_url, watchers, deadline, latencies, errors):
+    session = requests.Session()
+    choices = scenarios(base_url, watchers)
+    while time.monotonic() < deadline:
+        began = time.monotonic()
+        try:
+            resp = random.choice(choices)(session)
+            ok = resp.status_code == 200
+        except requests.RequestException:
+            ok = False
+        latencies.append(time.monotonic() - began)
+        if not ok:
+            errors.append(1)
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--seconds', type=float, default=20)
+    parser.add_argument('--watchers', type=int, default=200)
+    args = parser.parse_args()
+
+    watchers = app.WATCHERS.list()
+    for _ in range(args.watchers - len(watchers)):
+        watcher = app.make_watcher('ULOADTEST', 'yosemite', '01/07/19', 2)
+        watcher['silenced'] = True
+        app.WATCHERS.append(watcher)
+    watchers = app.WATCHERS.list()
+    for watcher in watchers:
+        watcher['results'] = [make_result(watcher, site) for site in range(10)]
+        watcher['results_fingerprint'] = app.results_fingerprint(watcher['results'])
+    app.WATCHERS.update_many(watchers)
+
+    latencies = []
+    errors = []
+    deadline = time.monotonic() + args.seconds
+    threads = [
+        threading.Thread(target=client, args=(args.url, watchers, deadline, latencies, errors))
+        for _ in range(args.clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    print("requests:   {}".format(len(latencies)))
+    print("errors:     {}".format(len(errors)))
+    print("throughput: {:.1f} req/s".format(len(latencies) / args.seconds))
+    print("p50:        {:.1f} ms".format(percentile(latencies, 0.50) * 1000))
+    print("p99:        {:.1f} ms".format(percentile(latencies, 0.99) * 1000))
+
+
+if __name__ == '__main__':
+    main()
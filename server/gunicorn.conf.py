@@ -0,0 +1,37 @@
+# Gunicorn settings for serving the API server in production. Every setting
+# can be overridden from the environment so that deployments can size the
+# server without rebuilding the image.
+import os
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+#: Processes serving requests. Watchers live in SQLite, which is safe to share
+#: between processes, so this can scale with the available cpus. Slack posts
+#: are paced per process, see CRUSHER_SLACK_CHANNEL_INTERVAL_SECONDS.
+workers = int(os.getenv('CRUSHER_WEB_WORKERS', '4'))
+#: Threads per process, so slow clients and slack don't tie up a process.
+worker_class = 'gthread'
+threads = int(os.getenv('CRUSHER_WEB_THREADS', '4'))
+#: Seconds a request may take before its worker is restarted.
+timeout = int(os.getenv('CRUSHER_WEB_TIMEOUT', '30'))
+# Each process opens its own database connections and starts its own slack
+# dispatcher, so the app must be imported after forking.
+preload_app = False
+accesslog = '-'
+
+# Every process records its prometheus metrics in files in this directory so
+# that /metrics reports the whole server rather than whichever process happens
+# to answer the scrape.
+os.environ.setdefault('PROMETHEUS_MULTIPROC_DIR', '/tmp/crusher-metrics')
+
+
+def on_starting(server):
+    # Start from a clean slate, files left by a previous run would be counted.
+    path = os.environ['PROMETHEUS_MULTIPROC_DIR']
+    os.makedirs(path, exist_ok=True)
+    for name in os.listdir(path):
+        os.remove(os.path.join(path, name))
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+    multiprocess.mark_process_dead(worker.pid)
@@ -1,180 +1,1663 @@
 #!/usr/bin/env python
 
+import asyncio
+import collections
+import contextlib
+import datetime
+import email.utils
+import heapq
+import itertools
 import json
 import logging
 import os
 import random
+import signal
+import socket
+import sqlite3
+import sys
+import threading
 import time
+import zlib
 from pathlib import Path
 
+import aiohttp
 import arrow
 import requests
 import schedule
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
 from slackclient import SlackClient
 
-logging.basicConfig(level=logging.DEBUG)
+try:
+    # Decodes availability payloads about twice as fast as the standard
+    # library, when it is installed.
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+#: Minimum level of log messages, e.g. DEBUG, INFO or WARNING.
+CRUSHER_LOG_LEVEL = os.getenv('CRUSHER_LOG_LEVEL', 'INFO')
+#: `json` to log one json object per line, or `text`.
+CRUSHER_LOG_FORMAT = os.getenv('CRUSHER_LOG_FORMAT', 'text')
+#: Messages longer than this many characters are truncated.
+CRUSHER_LOG_MAX_CHARS = int(os.getenv('CRUSHER_LOG_MAX_CHARS', '4096'))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats log records as single line json objects.
+    """
+    converter = time.gmtime
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, '%Y-%m-%dT%H:%M:%SZ'),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class TruncatingFilter(logging.Filter):
+    """
+    Caps the length of log messages. As a handler filter it only sees records
+    that are actually emitted, so messages below the log level are never
+    formatted at all.
+    """
+
+    def __init__(self, max_chars):
+        super(TruncatingFilter, self).__init__()
+        self.max_chars = max_chars
+
+    def filter(self, record):
+        message = record.getMessage()
+        if len(message) > self.max_chars:
+            record.msg = "{}... ({} characters truncated)".format(
+                message[:self.max_chars],
+                len(message) - self.max_chars,
+            )
+            record.args = None
+        return True
+
+
+def configure_logging(level, format, max_chars):
+    handler = logging.StreamHandler()
+    handler.addFilter(TruncatingFilter(max_chars))
+    if format == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+    logging.basicConfig(level=level.upper(), handlers=[handler])
+
+
+configure_logging(CRUSHER_LOG_LEVEL, CRUSHER_LOG_FORMAT, CRUSHER_LOG_MAX_CHARS)
 LOGGER = logging.getLogger(__name__)
 
 #: Url format for HTTP api requests to recreation.gov for a given campsite id.
 CAMPGROUND_URL = "https://www.recreation.gov/camping/campgrounds/{id}"
+#: Url format for the recreation.gov api serving a month of availabilities for
+#: a given campground id.
+AVAILABILITY_URL = os.getenv(
+    'CRUSHER_AVAILABILITY_URL',
+    "https://www.recreation.gov/api/camps/availability/campground/{id}/month",
+)
+#: recreation.gov rejects requests that don't look like they're from a browser.
+USER_AGENT = 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/73.0.3683.75 Safari/537.36'
 CRUSHER_HOST = os.getenv('CRUSHER_HOST', 'http://localhost:5000')
-CRUSHER_RESULTS_URL = os.getenv('CRUSHER_RESULTS_URL', '{}/watchers/{{id}}/results'.format(CRUSHER_HOST))
+CRUSHER_RESULTS_BATCH_URL = os.getenv('CRUSHER_RESULTS_BATCH_URL', '{}/watchers/results:batch'.format(CRUSHER_HOST))
+#: Maximum number of watchers' results posted to the API server per request.
+CRUSHER_RESULTS_BATCH_SIZE = int(os.getenv('CRUSHER_RESULTS_BATCH_SIZE', '200'))
 CRUSHER_CAMPGROUNDS_URL = os.getenv('CRUSHER_CAMPGROUNDS_URL', '{}/meta/campgrounds'.format(CRUSHER_HOST))
-CRUSHER_WATCHER_LISTING_URL = os.getenv('CRUSHER_WATCHER_LISTING_URL', '{}/watchers'.format(CRUSHER_HOST))
-CRUSHER_POLLING_INTERVAL_MINUTES = int(os.getenv('CRUSHER_POLLING_INTERVAL_MINUTES', '3'))
+CRUSHER_WATCHER_CHANGES_URL = os.getenv('CRUSHER_WATCHER_CHANGES_URL', '{}/watchers/changes'.format(CRUSHER_HOST))
+CRUSHER_LEASE_CLAIM_URL = os.getenv('CRUSHER_LEASE_CLAIM_URL', '{}/leases/claim'.format(CRUSHER_HOST))
+CRUSHER_LEASE_RELEASE_URL = os.getenv('CRUSHER_LEASE_RELEASE_URL', '{}/leases/release'.format(CRUSHER_HOST))
+#: Identifies this worker when leasing shards of the watchers; the pod name
+#: when running in kubernetes.
+CRUSHER_WORKER_ID = os.getenv('CRUSHER_WORKER_ID', socket.gethostname())
+#: How long our leases last without being renewed. This should comfortably
+#: exceed the scheduler tick.
+CRUSHER_LEASE_TTL_SECONDS = float(os.getenv('CRUSHER_LEASE_TTL_SECONDS', '600'))
+#: How often the worker checks for campground-months that are due a poll.
+CRUSHER_SCHEDULER_TICK_SECONDS = int(os.getenv('CRUSHER_SCHEDULER_TICK_SECONDS', '15'))
+#: How often a campground-month is polled, by how many days away the earliest
+#: night a watcher wants in it is: `<days-away>:<seconds>` pairs, see
+#: `parse_thresholds`. Months that change often are polled more frequently,
+#: and months whose wanted nights have all passed at the longest interval.
+CRUSHER_POLL_INTERVALS = os.getenv('CRUSHER_POLL_INTERVALS', '0:60,7:180,30:600,90:1800')
+#: Global budget of campground-month polls across all watchers.
+CRUSHER_REQUESTS_PER_MINUTE = float(os.getenv('CRUSHER_REQUESTS_PER_MINUTE', '60'))
+#: Maximum number of in-flight requests to recreation.gov during a cycle.
+CRUSHER_FETCH_CONCURRENCY = int(os.getenv('CRUSHER_FETCH_CONCURRENCY', '8'))
+#: Total time allowed for a single recreation.gov request.
+CRUSHER_FETCH_TIMEOUT_SECONDS = float(os.getenv('CRUSHER_FETCH_TIMEOUT_SECONDS', '30'))
+#: Sustained rate of requests to recreation.gov, shared by all fetches.
+CRUSHER_UPSTREAM_REQUESTS_PER_SECOND = float(os.getenv('CRUSHER_UPSTREAM_REQUESTS_PER_SECOND', '5'))
+#: Retries of a throttled or failed request, with jittered exponential backoff
+#: starting at CRUSHER_FETCH_BACKOFF_SECONDS.
+CRUSHER_FETCH_RETRIES = int(os.getenv('CRUSHER_FETCH_RETRIES', '3'))
+CRUSHER_FETCH_BACKOFF_SECONDS = float(os.getenv('CRUSHER_FETCH_BACKOFF_SECONDS', '1'))
+CRUSHER_FETCH_BACKOFF_MAX_SECONDS = float(os.getenv('CRUSHER_FETCH_BACKOFF_MAX_SECONDS', '60'))
+#: Consecutive failed fetches after which a campground is left alone for
+#: CRUSHER_BREAKER_COOLDOWN_SECONDS.
+CRUSHER_BREAKER_THRESHOLD = int(os.getenv('CRUSHER_BREAKER_THRESHOLD', '5'))
+CRUSHER_BREAKER_COOLDOWN_SECONDS = float(os.getenv('CRUSHER_BREAKER_COOLDOWN_SECONDS', '300'))
+#: Approximate memory budget for cached month grids.
+CRUSHER_CACHE_MAX_BYTES = int(os.getenv('CRUSHER_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+#: How long a cached month is served without revalidation, by how many months
+#: away it is: `<months-away>:<seconds>` pairs, see `parse_thresholds`.
+CRUSHER_CACHE_TTLS = os.getenv('CRUSHER_CACHE_TTLS', '0:0,2:600,6:1800')
 HEARTBEAT_FILENAME = os.getenv('CRUSHER_HEARTBEAT_FILENAME', '/tmp/worker-health')
+#: SQLite database keeping the history of polled availability, see
+#: `SnapshotStore`.
+CRUSHER_SNAPSHOT_PATH = os.getenv('CRUSHER_SNAPSHOT_PATH', '/tmp/crusher-snapshots.sqlite3')
+#: Days of availability changes to keep.
+CRUSHER_SNAPSHOT_RETENTION_DAYS = float(os.getenv('CRUSHER_SNAPSHOT_RETENTION_DAYS', '30'))
+#: Fraction of recreation.gov responses to log at DEBUG level, payloads are
+#: large enough that logging every one of them fills up disks.
+CRUSHER_LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('CRUSHER_LOG_PAYLOAD_SAMPLE_RATE', '0'))
+#: Port to serve prometheus metrics on, metrics aren't served if unset.
+CRUSHER_METRICS_PORT = os.getenv('CRUSHER_METRICS_PORT')
 #: The API token for the slack bot can be obtained via:
 #: https://api.slack.com/apps/AD3G033C4/oauth?
 SLACK_API_KEY = os.getenv('SLACK_API_KEY')
 
 
-def campgrounds():
-    try:
-        resp = requests.get(CRUSHER_CAMPGROUNDS_URL)
-        resp.raise_for_status()
-        return resp.json()
-    except:
-        LOGGER.exception("failed to get campgrounds - proceeding with empty campgrounds.")
-        return []
+CYCLE_SECONDS = Histogram(
+    'crusher_worker_cycle_seconds',
+    'Time spent on a polling cycle.',
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+LAST_CYCLE = Gauge(
+    'crusher_worker_last_cycle_timestamp_seconds',
+    'When the last polling cycle finished.',
+)
+WATCHERS_OWNED = Gauge(
+    'crusher_worker_watchers',
+    'Watchers handled by this worker.',
+)
+WATCHERS_EVALUATED = Counter(
+    'crusher_worker_watchers_evaluated_total',
+    'Watchers evaluated against freshly polled months.',
+)
+MONTHS_DUE = Counter(
+    'crusher_worker_months_due_total',
+    'Campground-months due to be polled.',
+)
+FETCH_SECONDS = Histogram(
+    'crusher_worker_fetch_seconds',
+    'Latency of requests to recreation.gov.',
+    ['campground'],
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+FETCHES = Counter(
+    'crusher_worker_fetches_total',
+    'Requests to recreation.gov by response status, or "error" when there was none.',
+    ['status'],
+)
+CACHE_LOOKUPS = Counter(
+    'crusher_worker_cache_lookups_total',
+    'Availability cache lookups by result.',
+    ['result'],
+)
+DECODE_SECONDS = Histogram(
+    'crusher_worker_decode_seconds',
+    'Time spent decoding a month of availabilities.',
+)
+EVALUATE_SECONDS = Histogram(
+    'crusher_worker_evaluate_seconds',
+    'Time spent evaluating watchers in a cycle.',
+)
+RESULTS_POSTED = Counter(
+    'crusher_worker_results_posted_total',
+    'Watcher results posted to the API server by outcome.',
+    ['outcome'],
+)
+SLACK_MESSAGES = Counter(
+    'crusher_worker_slack_messages_total',
+    'Slack messages sent by outcome.',
+    ['outcome'],
+)
+
+
+class CampgroundCatalog(object):
+    """
+    A local copy of the server's campground catalog, indexed by tag.
+
+    The catalog is revalidated against the server's ETag once per cycle and
+    the index is only rebuilt when it changes. If the server can't be reached
+    we keep using the last catalog we saw rather than pretending there are no
+    campgrounds.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.etag = None
+        self.by_tag = None
+
+    def refresh(self):
+        """
+        :raises requests.RequestException: If the catalog has never been
+            loaded and the server can't provide it.
+        """
+        headers = {'If-None-Match': self.etag} if self.etag else {}
+        try:
+            resp = requests.get(self.url, headers=headers)
+            if resp.status_code == 304:
+                return
+            resp.raise_for_status()
+        except requests.RequestException:
+            if self.by_tag is None:
+                raise
+            LOGGER.exception("failed to refresh campgrounds - proceeding with cached catalog.")
+            return
+
+        by_tag = collections.defaultdict(list)
+        for cg in resp.json():
+            for tag in cg['tags']:
+                by_tag[tag].append(cg)
+        self.by_tag = dict(by_tag)
+        self.etag = resp.headers.get('ETag')
+        LOGGER.info("loaded campground catalog version %s", self.etag)
+
+    def campgrounds_by_tag(self, tag):
+        return self.by_tag.get(tag, [])
+
+
+#: The campground catalog, refreshed at the start of every cycle.
+CATALOG = CampgroundCatalog(CRUSHER_CAMPGROUNDS_URL)
 
 
 def campgrounds_by_tag(tag):
-    results = []
-    for cg in campgrounds():
-        if tag in cg['tags']:
-            results.append(cg)
-    return results
+    return CATALOG.campgrounds_by_tag(tag)
 
 
-def send_watcher_results(watcher_id, results):
+def send_results_batch(results_by_watcher):
     """
-    :param watcher_id: The job id used to correlate with a watch task on the web server.
-    :param results: A list of dicts with a fairly ad-hoc structure.
+    Posts the results of a cycle to the API server, in chunks of at most
+    CRUSHER_RESULTS_BATCH_SIZE watchers per request.
+
+    :param results_by_watcher: A dict of watcher id to a dict with the ids
+        of the `campgrounds` this worker evaluated the watcher against and the
+        `results` for them, a list of dicts with a fairly ad-hoc structure.
+    :returns: The ids of the watchers the server accepted results for.
     """
-    LOGGER.debug("got results %s", results)
-    resp = requests.post(
-        CRUSHER_RESULTS_URL.format(**{'id': watcher_id}),
-        json=results,
-    )
-    if resp.status_code != 200:
-        LOGGER.debug("unexpected status posting results: %d", resp.status_code)
+    accepted = []
+    watcher_ids = list(results_by_watcher)
+    for i in range(0, len(watcher_ids), CRUSHER_RESULTS_BATCH_SIZE):
+        chunk = {
+            watcher_id: results_by_watcher[watcher_id]
+            for watcher_id in watcher_ids[i:i + CRUSHER_RESULTS_BATCH_SIZE]
+        }
+        resp = requests.post(CRUSHER_RESULTS_BATCH_URL, json=chunk)
+        if resp.status_code != 200:
+            LOGGER.error("unexpected status posting results: %d", resp.status_code)
+            RESULTS_POSTED.labels('error').inc(len(chunk))
+            continue
+        for watcher_id, status in resp.json().items():
+            RESULTS_POSTED.labels(status).inc()
+            if status == 'ok':
+                accepted.append(watcher_id)
+            else:
+                LOGGER.info("results for watcher %s were not stored: %s", watcher_id, status)
+    return accepted
+
+
+class WatcherMirror(object):
+    """
+    A local copy of the API server's watchers, kept up to date by applying
+    the server's change feed. Stored results aren't needed by the worker and
+    are left out of the feed.
+    """
+
+    def __init__(self, url):
+        self.url = url
+        self.revision = 0
+        self.watchers = {}
+
+    def sync(self):
+        """
+        Applies changes since the last sync. If the server can't be reached the
+        mirror is left as it was.
+
+        :returns: The list of watchers.
+        """
+        try:
+            resp = requests.get(self.url, params={'since': self.revision, 'slim': 1})
+            resp.raise_for_status()
+        except requests.RequestException:
+            LOGGER.exception("failed to sync watchers - proceeding with %d known watchers.", len(self.watchers))
+            return list(self.watchers.values())
+
+        changes = resp.json()
+        for watcher_id in changes['removed']:
+            self.watchers.pop(watcher_id, None)
+        for watcher in changes['watchers']:
+            self.watchers[watcher['id']] = watcher
+        LOGGER.info(
+            "synced watchers from revision %d to %d: %d changed, %d removed",
+            self.revision,
+            changes['revision'],
+            len(changes['watchers']),
+            len(changes['removed']),
+        )
+        self.revision = changes['revision']
+        return list(self.watchers.values())
+
+
+#: Watchers registered with the API server.
+WATCHERS = WatcherMirror(CRUSHER_WATCHER_CHANGES_URL)
+
+
+def campground_shard(campground_id, shard_count):
+    """
+    The work is sharded by campground, so every month of a campground is
+    fetched by exactly one worker no matter how many tags, and watchers,
+    include it. A watcher is evaluated by each worker holding one of its
+    campgrounds, against just those campgrounds.
+    """
+    return zlib.crc32(campground_id.encode('utf-8')) % shard_count
+
+
+class LeaseKeeper(object):
+    """
+    Holds this worker's leases on shards of the campgrounds so that a fleet of
+    workers can split them up. Leases are claimed from the API server at the
+    start of every cycle and renewed in the background while the cycle runs;
+    if we die, the server hands our shards to someone else once they expire.
+    """
+
+    def __init__(self, claim_url, release_url, worker, ttl):
+        self.claim_url = claim_url
+        self.release_url = release_url
+        self.worker = worker
+        self.ttl = ttl
+        self.shards = set()
+        self.shard_count = 1
+
+    def claim(self):
+        """
+        Claims or renews our leases.
+
+        :raises requests.RequestException: If the API server can't be reached.
+        """
+        resp = requests.post(self.claim_url, json={'worker': self.worker, 'ttl': self.ttl})
+        resp.raise_for_status()
+        leases = resp.json()
+        if set(leases['shards']) != self.shards:
+            LOGGER.info("worker %s now holds shards %s of %d", self.worker, leases['shards'], leases['shard_count'])
+        self.shards = set(leases['shards'])
+        self.shard_count = leases['shard_count']
+
+    @contextlib.contextmanager
+    def renewing(self):
+        """
+        Renews our leases in the background until the block exits.
+        """
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(self.ttl / 3):
+                try:
+                    self.claim()
+                except requests.RequestException:
+                    LOGGER.exception("failed to renew leases")
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def owns(self, campground):
+        return campground_shard(campground['id'], self.shard_count) in self.shards
+
+    def release(self):
+        try:
+            requests.post(self.release_url, json={'worker': self.worker})
+        except requests.RequestException:
+            LOGGER.exception("failed to release leases")
+
+
+#: Our share of the watchers.
+LEASES = LeaseKeeper(
+    CRUSHER_LEASE_CLAIM_URL,
+    CRUSHER_LEASE_RELEASE_URL,
+    CRUSHER_WORKER_ID,
+    CRUSHER_LEASE_TTL_SECONDS,
+)
 
 
 def get_watchers():
     """
     Obtains the list of watcher tasks from the API server.
     """
-    resp = requests.get(CRUSHER_WATCHER_LISTING_URL)
-    if resp.status_code != 200:
-        LOGGER.error("failed to list watchers")
-    return resp.json()
+    return WATCHERS.sync()
 
 
-def availability_fraction(site, start_date, end_date):
-    interested_dates = []
-    total_days = (end_date - start_date).days
-    total_matched = 0.0
-    for avdate, status in list(site['availabilities'].items()):
-        avparsed = arrow.get(avdate)
-        # Ignore dates outside of our interested range.
-        if not (avparsed >= start_date and avparsed < end_date):
-            continue
-        if status.lower() == 'available':
-            total_matched = total_matched + 1
-    return total_matched / total_days
-
-
-def run(watcher, date, length, campground):
-    start_date = arrow.get(date, 'DD/MM/YY')
-    end_date = start_date.shift(days=length)
-
-    # A sample site payload:
-    # {
-    #     "availabilities": {
-    #         "2018-10-05T00:00:00Z": "Reserved",
-    #         ...
-    #         "2018-10-20T00:00:00Z": "reserved"
-    #     },
-    #     "campsite_id": "99",
-    #     "campsite_reserve_type": "Site-Specific",
-    #     "loop": "UPPER PINES ",
-    #     "quantities": null,
-    #     "site": "043"
-    # }
-    resp = requests.get(
-        'https://www.recreation.gov/api/camps/availability/campground/{id}/month'.format(id=campground['id']),
-        headers={'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/73.0.3683.75 Safari/537.36'},
-        params={
-            'start_date': start_date.format('YYYY-MM-01T00:00:00.000') + 'Z',
+class Site(object):
+    """
+    The parts of a campsite we keep from an availability payload: its
+    recreation.gov id, the site number shown to people, and the loop it is in.
+    """
+    __slots__ = ('id', 'site', 'loop')
+
+    def __init__(self, id, site, loop):
+        self.id = id
+        self.site = site
+        self.loop = loop
+
+    def to_json(self):
+        return {
+            "campsite_id": self.id,
+            "site": self.site,
+            "loop": self.loop,
         }
+
+
+class MonthGrid(object):
+    """
+    A month of availabilities for a campground, decoded once per fetch into a
+    bitmap per site where bit `n` is set if the site is available on day `n`
+    of the month (counting from zero). Evaluating a stay is then a mask and a
+    popcount per site rather than parsing every date string for every watcher.
+
+    Only the grid is kept, the decoded payload is dropped as soon as it has
+    been projected into `Site` records and bitmaps.
+    """
+    __slots__ = ('month', 'days', 'sites')
+
+    def __init__(self, month, sites):
+        self.month = month
+        self.days = (month.shift(months=1) - month).days
+        #: A dict of site id to a tuple of `(site, bitmap)`.
+        self.sites = sites
+
+    @classmethod
+    def decode(cls, month, payload):
+        # Dates look like "2018-10-05T00:00:00Z", so rather than parsing them
+        # we check the month prefix and slice out the day.
+        prefix = month.format('YYYY-MM')
+        sites = {}
+        for site_id, site in payload['campsites'].items():
+            bitmap = 0
+            for avdate, status in site['availabilities'].items():
+                if avdate.startswith(prefix) and status.lower() == 'available':
+                    bitmap |= 1 << (int(avdate[8:10]) - 1)
+            sites[site_id] = (Site(site_id, site.get('site'), site.get('loop')), bitmap)
+        return cls(month, sites)
+
+    @classmethod
+    def parse(cls, month, body):
+        """
+        Decodes a raw availability response body.
+        """
+        with DECODE_SECONDS.time():
+            return cls.decode(month, json_loads(body))
+
+    def approximate_size(self):
+        """
+        Estimates the memory held by the grid, for the cache's budget.
+        """
+        size = sys.getsizeof(self.sites)
+        for site_id, (site, bitmap) in self.sites.items():
+            size += sys.getsizeof(site_id) + sys.getsizeof(site) + sys.getsizeof(bitmap) + 64
+            size += sys.getsizeof(site.site) + sys.getsizeof(site.loop)
+        return size
+
+
+def window_mask(start, end):
+    """
+    Returns a bitmap with bits `[start, end)` set.
+    """
+    if end <= start:
+        return 0
+    return ((1 << end) - 1) ^ ((1 << start) - 1)
+
+
+def availability_fraction(bitmap, mask, total_days):
+    return bin(bitmap & mask).count('1') / total_days
+
+
+def best_window(bitmap, first, last, length, min_fraction=0, nights=1):
+    """
+    Finds the `length` day window starting on a day in `[first, last]` with
+    the most days set in `bitmap`, among the windows with at least
+    `min_fraction` of their days set and a run of `nights` set days.
+
+    Builds prefix sums over the days, and over the days that start a run of
+    `nights`, once so that every candidate start is answered with a couple of
+    subtractions, and stops at the first fully set window.
+
+    :returns: A tuple of `(count, start)` for the earliest best window, with a
+        count of 0 if no window qualifies.
+    """
+    runs = bitmap
+    for _ in range(nights - 1):
+        runs &= runs >> 1
+    sums = [0]
+    run_sums = [0]
+    for day in range(first, last + length):
+        sums.append(sums[-1] + (bitmap >> day & 1))
+        run_sums.append(run_sums[-1] + (runs >> day & 1))
+    best, best_start = 0, first
+    for offset in range(last - first + 1):
+        count = sums[offset + length] - sums[offset]
+        if count <= best or count / length < min_fraction:
+            continue
+        # A run of `nights` fits if one starts no later than `length - nights`
+        # days into the window.
+        if nights > 1 and run_sums[offset + length - nights + 1] == run_sums[offset]:
+            continue
+        best, best_start = count, first + offset
+        if best == length:
+            break
+    return best, best_start
+
+
+def has_consecutive(bitmap, nights):
+    """
+    Returns whether `bitmap` has a run of at least `nights` set bits. Each
+    step keeps only the bits that start a run one longer than the last.
+    """
+    for _ in range(nights - 1):
+        if not bitmap:
+            break
+        bitmap &= bitmap >> 1
+    return bitmap != 0
+
+
+def parse_thresholds(spec):
+    """
+    Parses a comma separated list of `<threshold>:<seconds>` pairs, e.g.
+    `0:0,2:600,6:1800`, into a list sorted by threshold.
+    """
+    thresholds = []
+    for pair in spec.split(','):
+        threshold, seconds = pair.split(':')
+        thresholds.append((int(threshold), float(seconds)))
+    return sorted(thresholds)
+
+
+def threshold_value(thresholds, value):
+    """
+    Returns the seconds of the highest threshold that `value` reaches, or of
+    the lowest threshold if it reaches none of them.
+    """
+    seconds = thresholds[0][1]
+    for threshold, threshold_seconds in thresholds:
+        if value < threshold:
+            break
+        seconds = threshold_seconds
+    return seconds
+
+
+def month_key(campground_id, date):
+    """
+    Returns the key identifying a single month of availabilities for a
+    campground. The availability api is paginated by month, so this is the
+    unit of work we fetch and share between watchers.
+    """
+    return (campground_id, date.format('YYYY-MM-01'))
+
+
+def stay_months(start_date, end_date):
+    """
+    Returns the start date of every month touched by a stay from `start_date`
+    up to, but not including, `end_date`.
+    """
+    last_night = max(start_date, end_date.shift(days=-1))
+    return arrow.Arrow.range('month', start_date.floor('month'), last_night.floor('month'))
+
+
+def stay_dates(watcher):
+    """
+    Returns the first night and the day after the last night that a watcher
+    could stay. Flexible watchers, with an `until` constraint, may arrive on
+    any day up to and including `until`.
+    """
+    start_date = arrow.get(watcher['start'], 'DD/MM/YY')
+    until = (watcher.get('constraints') or {}).get('until')
+    last_arrival = arrow.get(until, 'DD/MM/YY') if until else start_date
+    return start_date, last_arrival.shift(days=watcher['length'])
+
+
+def watcher_spec(watcher, campgrounds):
+    """
+    The parts of a watcher that decide its results. The campgrounds its tag
+    resolves to are included since tags can be edited in the catalog.
+    """
+    return (
+        watcher['campground'],
+        watcher['start'],
+        watcher['length'],
+        json.dumps(watcher.get('constraints'), sort_keys=True),
+        tuple(campground['id'] for campground in campgrounds),
+    )
+
+
+def plan_fetches(watchers, owns=None):
+    """
+    Collects the distinct campground-months needed to evaluate every watcher in
+    a polling cycle so that each is fetched exactly once, regardless of how many
+    watchers are interested in it.
+
+    :param owns: A predicate for the campgrounds this worker is responsible
+        for, see `LeaseKeeper.owns`. Watchers without any are left out.
+    :returns: A tuple of `(jobs, months, first_nights)`. `jobs` is a list of
+        `(watcher, campgrounds, keys)` tuples giving the campgrounds each
+        watcher covers and the `month_key` of every month it needs, `months`
+        maps a `month_key` to the first day of that month and `first_nights`
+        maps it to the earliest night that any watcher wants in that month
+        and can still book, or None once all of them have passed.
+    """
+    jobs = []
+    months = {}
+    first_nights = {}
+    today = arrow.utcnow().floor('day')
+    for watcher in watchers:
+        campgrounds = campgrounds_by_tag(watcher['campground'])
+        if owns is not None:
+            campgrounds = [cg for cg in campgrounds if owns(cg)]
+            if not campgrounds:
+                continue
+        start_date, end_date = stay_dates(watcher)
+        keys = set()
+        for cg in campgrounds:
+            for month in stay_months(start_date, end_date):
+                key = month_key(cg['id'], month)
+                keys.add(key)
+                months[key] = month
+                first_night = max(start_date, month, today)
+                if first_night >= min(end_date, month.shift(months=1)):
+                    first_night = None
+                known = first_nights.get(key)
+                if key not in first_nights or known is None or (first_night is not None and first_night < known):
+                    first_nights[key] = first_night
+        jobs.append((watcher, campgrounds, keys))
+    LOGGER.info(
+        "planned %d campground-months for %d watchers",
+        len(months),
+        len(jobs),
     )
+    return jobs, months, first_nights
+
+
+class WatcherIndex(object):
+    """
+    An interval index from campground-months to the watchers whose stays
+    overlap them, for finding the watchers affected by a change in
+    availability without looking at every watcher.
+
+    A watcher's stay is split into one interval of days per campground-month
+    it touches. Months are at most 31 days long, so rather than an interval
+    tree each month keeps a bucket of watcher ids per day, and a lookup
+    unions the buckets of the days that changed.
+    """
+
+    def __init__(self):
+        #: A dict of `month_key` to a list of sets of watcher ids, by day.
+        self.days = {}
+        #: A dict of watcher id to `(spec, intervals)`, where `intervals` is a
+        #: list of `(month_key, first_day, end_day)` tuples.
+        self.watchers = {}
+
+    def sync(self, jobs):
+        """
+        Indexes new and edited watchers and drops those that are gone.
+
+        :param jobs: See `plan_fetches`.
+        """
+        seen = set()
+        for watcher, campgrounds, keys in jobs:
+            seen.add(watcher['id'])
+            spec = watcher_spec(watcher, campgrounds)
+            indexed = self.watchers.get(watcher['id'])
+            if indexed is not None and indexed[0] == spec:
+                continue
+            self.remove(watcher['id'])
+            intervals = list(self.intervals(watcher, campgrounds))
+            for key, first_day, end_day in intervals:
+                days = self.days.setdefault(key, [set() for _ in range(31)])
+                for day in range(first_day, end_day):
+                    days[day].add(watcher['id'])
+            self.watchers[watcher['id']] = (spec, intervals)
+        for watcher_id in set(self.watchers) - seen:
+            self.remove(watcher_id)
+
+    def intervals(self, watcher, campgrounds):
+        start_date, end_date = stay_dates(watcher)
+        for month in stay_months(start_date, end_date):
+            first_day = (max(start_date, month) - month).days
+            end_day = (min(end_date, month.shift(months=1)) - month).days
+            for cg in campgrounds:
+                yield month_key(cg['id'], month), first_day, end_day
+
+    def remove(self, watcher_id):
+        indexed = self.watchers.pop(watcher_id, None)
+        if indexed is None:
+            return
+        for key, first_day, end_day in indexed[1]:
+            days = self.days[key]
+            for day in range(first_day, end_day):
+                days[day].discard(watcher_id)
+            if not any(days):
+                del self.days[key]
+
+    def affected(self, deltas):
+        """
+        Returns the ids of watchers whose stays overlap any changed day.
+
+        :param deltas: A dict of `month_key` to `MonthDelta`.
+        """
+        watcher_ids = set()
+        for key, delta in deltas.items():
+            days = self.days.get(key)
+            if days is None:
+                continue
+            changed = delta.changed_days
+            day = 0
+            while changed:
+                if changed & 1:
+                    watcher_ids.update(days[day])
+                changed >>= 1
+                day += 1
+        return watcher_ids
+
+
+#: Where the watchers we handle want to stay, see `WatcherIndex`.
+INDEX = WatcherIndex()
+
+
+class PollScheduler(object):
+    """
+    Decides which campground-months are due a poll.
+
+    Months are kept in a priority queue ordered by when they're next due. How
+    soon that is depends on how close the earliest night a watcher wants in
+    the month is, and is shortened for months whose availability changed
+    recently or changes often, since that is where cancellations turn up.
+
+    Polls are paid for out of a token bucket refilled at `requests_per_minute`
+    so that we stay within our upstream budget no matter how many months are
+    due; when we're over budget the most overdue months go first.
+    """
+    #: How long a month counts as having changed recently.
+    RECENT_CHANGE_SECONDS = 3600
+    #: Weight given to past polls when tracking how often a month changes.
+    CHANGE_RATE_DECAY = 0.8
+
+    def __init__(self, requests_per_minute, intervals, min_interval):
+        self.rate = requests_per_minute / 60.0
+        self.capacity = requests_per_minute
+        self.tokens = requests_per_minute
+        self.refilled_at = time.time()
+        self.intervals = intervals
+        self.min_interval = min_interval
+        self.queue = []
+        self.units = {}
+
+    def update(self, first_nights, now=None, last_changed=None):
+        """
+        Starts tracking newly needed months, which are due immediately, and
+        stops tracking months that no watcher needs anymore.
+
+        :param first_nights: See `plan_fetches`.
+        :param last_changed: Optionally, a function returning when a month's
+            availability last changed, so that months tracked after a restart
+            keep being polled as often as before. See `SnapshotStore`.
+        """
+        now = now or time.time()
+        for key in list(self.units):
+            if key not in first_nights:
+                del self.units[key]
+        for key, first_night in first_nights.items():
+            unit = self.units.get(key)
+            if unit is None:
+                unit = self.units[key] = {
+                    'due': now,
+                    'changed_at': last_changed(key) if last_changed else None,
+                    'change_rate': 0.0,
+                }
+                heapq.heappush(self.queue, (now, key))
+            unit['first_night'] = first_night.float_timestamp if first_night is not None else None
+
+    def due(self, now=None):
+        """
+        Returns the keys of months to poll now. Every key returned must be
+        passed back to `record` to be scheduled again.
+        """
+        now = now or time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.refilled_at) * self.rate)
+        self.refilled_at = now
+
+        keys = []
+        while self.queue and self.queue[0][0] <= now and self.tokens >= 1:
+            due, key = heapq.heappop(self.queue)
+            unit = self.units.get(key)
+            # Skip entries for months we've stopped tracking.
+            if unit is None or unit['due'] != due:
+                continue
+            unit['due'] = None
+            keys.append(key)
+            self.tokens -= 1
+        return keys
+
+    def record(self, key, changed, now=None):
+        """
+        Schedules the next poll of a month.
+
+        :param changed: Whether the month's availability changed since it was
+            last polled, see `MonthDelta.changed`, or None if polling it failed
+            or it has never been polled before.
+        """
+        now = now or time.time()
+        unit = self.units.get(key)
+        if unit is None:
+            return
+        if changed is not None:
+            unit['change_rate'] = self.CHANGE_RATE_DECAY * unit['change_rate'] + (1 - self.CHANGE_RATE_DECAY) * changed
+            if changed:
+                unit['changed_at'] = now
+        unit['due'] = now + self.interval(unit, now)
+        heapq.heappush(self.queue, (unit['due'], key))
+
+    def interval(self, unit, now):
+        if unit['first_night'] is None:
+            # Every night wanted in the month has passed. It's still polled,
+            # rarely, so that watchers spanning it can be evaluated.
+            return max(seconds for _, seconds in self.intervals)
+        days_away = (unit['first_night'] - now) / 86400
+        interval = threshold_value(self.intervals, days_away)
+        # Months that change on every poll are polled twice as often.
+        interval *= 1 - 0.5 * unit['change_rate']
+        if unit['changed_at'] is not None and now - unit['changed_at'] < self.RECENT_CHANGE_SECONDS:
+            interval *= 0.5
+        return max(self.min_interval, interval)
+
+
+#: Polling priorities of the campground-months our watchers need.
+SCHEDULER = PollScheduler(
+    CRUSHER_REQUESTS_PER_MINUTE,
+    parse_thresholds(CRUSHER_POLL_INTERVALS),
+    CRUSHER_SCHEDULER_TICK_SECONDS,
+)
+
+
+def notify_error(text):
+    try:
+        slack = SlackClient(SLACK_API_KEY)
+        slack.api_call(
+            "chat.postMessage",
+            channel="#campsites",
+            text=text,
+        )
+        SLACK_MESSAGES.labels('ok').inc()
+    except:
+        SLACK_MESSAGES.labels('error').inc()
+        LOGGER.exception('failed to notify slack of error')
+
+
+class AvailabilityCache(object):
+    """
+    An LRU cache of decoded `MonthGrid`s keyed by `month_key`.
 
-    if resp.status_code != 200:
-        LOGGER.error("request failed: %s, %s", watcher.get('user_id'), resp.headers, resp.content)
+    Entries younger than their TTL are served without touching
+    recreation.gov. Older entries keep their ETag and Last-Modified
+    validators around so that the next request can be made conditional, and a
+    304 lets us skip both the download and the json decode. TTLs are chosen by
+    how many months away from today the cached month is, since availability
+    far in the future churns a lot less than next weekend.
+
+    The memory cap is approximate, see `MonthGrid.approximate_size`.
+    """
+
+    def __init__(self, max_bytes, ttls):
+        self.max_bytes = max_bytes
+        self.ttls = ttls
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self.bytes_saved = 0
+
+    def ttl(self, month, now=None):
+        now = now or arrow.utcnow()
+        distance = (month.year - now.year) * 12 + month.month - now.month
+        return threshold_value(self.ttls, distance)
+
+    def get(self, key, month):
+        """
+        Returns the cached grid if it is still within its TTL.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry['fetched_at'] >= self.ttl(month):
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        CACHE_LOOKUPS.labels('hit').inc()
+        self.bytes_saved += entry['size']
+        return entry['grid']
+
+    def peek(self, key):
+        """
+        Returns the cached grid regardless of its age, without counting it as
+        a hit.
+        """
+        entry = self.entries.get(key)
+        return entry['grid'] if entry is not None else None
+
+    def validators(self, key):
+        """
+        Returns the conditional request headers for a stale entry.
+        """
+        entry = self.entries.get(key)
+        headers = {}
+        if entry is None:
+            return headers
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['last_modified']:
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def revalidated(self, key, grid):
+        """
+        Marks an entry as fresh after recreation.gov answered with a 304.
+
+        :param grid: The stale grid the conditional request was made for. It
+            is cached again if the entry was evicted while we were waiting.
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            entry = self._insert(key, grid, grid.approximate_size(), None, None)
+        entry['fetched_at'] = time.time()
+        self.entries.move_to_end(key)
+        self.not_modified += 1
+        CACHE_LOOKUPS.labels('not_modified').inc()
+        self.bytes_saved += entry['size']
+        return entry['grid']
+
+    def store(self, key, grid, size, etag=None, last_modified=None):
+        self.misses += 1
+        CACHE_LOOKUPS.labels('miss').inc()
+        self._insert(key, grid, size, etag, last_modified)
+
+    def _insert(self, key, grid, size, etag, last_modified):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= old['size']
+        entry = self.entries[key] = {
+            'grid': grid,
+            'size': size,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched_at': time.time(),
+        }
+        self.size += size
+        while self.size > self.max_bytes and len(self.entries) > 1:
+            _, evicted = self.entries.popitem(last=False)
+            self.size -= evicted['size']
+        return entry
+
+    def stats(self):
+        return {
+            'entries': len(self.entries),
+            'bytes': self.size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'not_modified': self.not_modified,
+            'bytes_saved': self.bytes_saved,
+        }
+
+
+#: Month grids shared between polling cycles.
+CACHE = AvailabilityCache(CRUSHER_CACHE_MAX_BYTES, parse_thresholds(CRUSHER_CACHE_TTLS))
+
+
+class MonthDelta(object):
+    """
+    How a campground-month's availability changed between two polls, as
+    bitmaps per site id of the days that `opened` up and the days that
+    `closed`. `first` is set when the month had never been polled before, in
+    which case everything available counts as opened.
+    """
+    __slots__ = ('month', 'opened', 'closed', 'first')
+
+    def __init__(self, month, opened, closed, first):
+        self.month = month
+        self.opened = opened
+        self.closed = closed
+        self.first = first
+
+    @property
+    def changed(self):
+        return bool(self.opened or self.closed)
+
+    @property
+    def changed_days(self):
+        """
+        A bitmap of the days on which any site opened or closed.
+        """
+        days = 0
+        for bitmap in itertools.chain(self.opened.values(), self.closed.values()):
+            days |= bitmap
+        return days
+
+    def opened_cells(self):
+        """
+        Yields a `(site_id, date)` tuple for every newly available night.
+        """
+        for site_id, bitmap in self.opened.items():
+            day = 0
+            while bitmap:
+                if bitmap & 1:
+                    yield site_id, self.month.shift(days=day)
+                bitmap >>= 1
+                day += 1
+
+
+class SnapshotStore(object):
+    """
+    A local, append-only history of the availability of every campground-month
+    we poll, kept in SQLite so that it outlives the worker process.
+
+    `latest` holds the most recent bitmap of every site, and every poll that
+    changes a site appends a row to `changes` with the days that opened and
+    closed since the previous poll, so a month's availability at any point in
+    the retention window can be rebuilt by folding its changes. Diffing a new
+    poll is a lookup of the month's latest bitmaps, which is what lets us
+    evaluate watchers only when the nights they care about change.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS months (
+            campground TEXT NOT NULL,
+            month TEXT NOT NULL,
+            polled_at REAL NOT NULL,
+            PRIMARY KEY (campground, month)
+        );
+        CREATE TABLE IF NOT EXISTS latest (
+            campground TEXT NOT NULL,
+            month TEXT NOT NULL,
+            site_id TEXT NOT NULL,
+            site TEXT,
+            bitmap INTEGER NOT NULL,
+            PRIMARY KEY (campground, month, site_id)
+        );
+        CREATE TABLE IF NOT EXISTS changes (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            observed_at REAL NOT NULL,
+            campground TEXT NOT NULL,
+            month TEXT NOT NULL,
+            site_id TEXT NOT NULL,
+            opened INTEGER NOT NULL,
+            closed INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS changes_month ON changes (campground, month, observed_at);
+        CREATE INDEX IF NOT EXISTS changes_site ON changes (campground, site_id, observed_at);
+        CREATE INDEX IF NOT EXISTS changes_observed_at ON changes (observed_at);
+    """
+
+    def __init__(self, path, retention_days):
+        self.path = path
+        self.retention = retention_days * 86400
+        self._conn = None
+
+    @property
+    def conn(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(self.SCHEMA)
+        return self._conn
+
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.conn
+        conn.execute('BEGIN IMMEDIATE')
         try:
-            slack = SlackClient(SLACK_API_KEY)
-            resp = slack.api_call(
-                "chat.postMessage",
-                channel="#campsites",
-                text="Campsite search failed for %s: <STATUS %s>: %s" % (watcher.get('user_id'), resp.text,resp.status_code),
-            )
+            yield conn
         except:
-            LOGGER.exception('failed to notify slack of error')
-        return []
-
-    LOGGER.debug("response from recreation.gov: %s", json.dumps(resp.json()))
-
-    responses = [resp.json()]
-    # The api requires getting availabilities by month at a time. If we're
-    # looking for a reservation that spans multiple months, we need to look at
-    # multiple months worth of availabilities. We assume that no one is staying
-    # longer than one month and will make at most 2 requests.
-    if start_date.month != end_date.month:
-        resp = requests.get(
-            'https://www.recreation.gov/api/camps/availability/campground/{id}/month'.format(id=campground['id']),
-            headers={'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_14_2) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/73.0.3683.75 Safari/537.36'},
-            params={
-                'start_date': end_date.format('YYYY-MM-01T00:00:00.000') + 'Z',
-            }
+            conn.execute('ROLLBACK')
+            raise
+        else:
+            conn.execute('COMMIT')
+
+    def record(self, grids, now=None):
+        """
+        Stores freshly polled months and diffs them against the previous poll.
+
+        :param grids: A dict of `month_key` to `MonthGrid`, or None for months
+            that failed to fetch, which are skipped.
+        :returns: A dict of `month_key` to `MonthDelta`.
+        """
+        now = now or time.time()
+        deltas = {}
+        with self.transaction() as conn:
+            for key, grid in grids.items():
+                if grid is None:
+                    continue
+                first = conn.execute(
+                    'SELECT 1 FROM months WHERE campground = ? AND month = ?',
+                    key,
+                ).fetchone() is None
+                conn.execute(
+                    'INSERT OR REPLACE INTO months (campground, month, polled_at) VALUES (?, ?, ?)',
+                    key + (now,),
+                )
+                previous = dict(conn.execute(
+                    'SELECT site_id, bitmap FROM latest WHERE campground = ? AND month = ?',
+                    key,
+                ))
+                listed = set(previous)
+                opened = {}
+                closed = {}
+                for site_id, (site, bitmap) in grid.sites.items():
+                    old = previous.pop(site_id, 0)
+                    if bitmap & ~old:
+                        opened[site_id] = bitmap & ~old
+                    if old & ~bitmap:
+                        closed[site_id] = old & ~bitmap
+                # Sites that are no longer listed at all.
+                for site_id, old in previous.items():
+                    if old:
+                        closed[site_id] = old
+                conn.executemany(
+                    'DELETE FROM latest WHERE campground = ? AND month = ? AND site_id = ?',
+                    [key + (site_id,) for site_id in previous],
+                )
+                conn.executemany(
+                    'INSERT OR REPLACE INTO latest (campground, month, site_id, site, bitmap) VALUES (?, ?, ?, ?, ?)',
+                    [
+                        key + (site_id, site.site, bitmap)
+                        for site_id, (site, bitmap) in grid.sites.items()
+                        if site_id in opened or site_id in closed or site_id not in listed
+                    ],
+                )
+                conn.executemany(
+                    'INSERT INTO changes (observed_at, campground, month, site_id, opened, closed) VALUES (?, ?, ?, ?, ?, ?)',
+                    [
+                        (now,) + key + (site_id, opened.get(site_id, 0), closed.get(site_id, 0))
+                        for site_id in set(opened) | set(closed)
+                    ],
+                )
+                deltas[key] = MonthDelta(grid.month, opened, closed, first)
+            self.prune(conn, now)
+        return deltas
+
+    def prune(self, conn, now):
+        """
+        Forgets changes older than the retention window, and months that
+        haven't been polled within it.
+        """
+        cutoff = now - self.retention
+        conn.execute('DELETE FROM changes WHERE observed_at < ?', (cutoff,))
+        conn.execute(
+            """
+            DELETE FROM latest WHERE EXISTS (
+                SELECT 1 FROM months
+                WHERE months.campground = latest.campground AND months.month = latest.month AND months.polled_at < ?
+            )
+            """,
+            (cutoff,),
         )
+        conn.execute('DELETE FROM months WHERE polled_at < ?', (cutoff,))
 
-        if resp.status_code != 200:
-            LOGGER.error("request failed: %s, %s", resp.headers, resp.content)
+    def last_changed(self, key):
+        """
+        Returns when a month's availability last changed, or None.
+        """
+        row = self.conn.execute(
+            'SELECT MAX(observed_at) FROM changes WHERE campground = ? AND month = ?',
+            key,
+        ).fetchone()
+        return row[0]
+
+    def history(self, campground_id, site, since=None):
+        """
+        Returns the nights that opened or closed at a site, by site number,
+        e.g. "043", as a list of `(observed_at, date, opened)` tuples in the
+        order they were seen.
+        """
+        rows = self.conn.execute(
+            """
+            SELECT observed_at, month, opened, closed FROM changes
+            WHERE campground = ? AND observed_at >= ? AND site_id IN (
+                SELECT site_id FROM latest WHERE campground = ? AND site = ?
+            )
+            ORDER BY seq
+            """,
+            (campground_id, since or 0, campground_id, site),
+        )
+        history = []
+        for observed_at, month, opened, closed in rows:
+            month = arrow.get(month)
+            for bitmap, is_opened in ((opened, True), (closed, False)):
+                day = 0
+                while bitmap:
+                    if bitmap & 1:
+                        history.append((observed_at, month.shift(days=day), is_opened))
+                    bitmap >>= 1
+                    day += 1
+        return history
+
+
+#: History of the availability of polled months.
+SNAPSHOTS = SnapshotStore(CRUSHER_SNAPSHOT_PATH, CRUSHER_SNAPSHOT_RETENTION_DAYS)
+
+
+class UpstreamLimiter(object):
+    """
+    Paces every request we make to recreation.gov.
+
+    Requests draw from a token bucket refilled at `requests_per_second`, and
+    the number of requests in flight is adapted AIMD style: it creeps up by
+    one for every window of successful requests and halves whenever we get
+    throttled, a 5xx or no response at all. A `Retry-After` header pauses all
+    requests until it has passed.
+
+    This is shared between cycles, so state is only ever touched from the
+    event loop thread and waiting is done by sleeping rather than with
+    asyncio primitives tied to a particular loop.
+    """
+
+    def __init__(self, requests_per_second, max_concurrency):
+        self.rate = requests_per_second
+        self.burst = max(1.0, requests_per_second)
+        self.tokens = self.burst
+        self.refilled_at = time.monotonic()
+        self.max_concurrency = max_concurrency
+        self.concurrency = float(max_concurrency)
+        self.in_flight = 0
+        self.blocked_until = 0
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.refilled_at) * self.rate)
+            self.refilled_at = now
+            if now < self.blocked_until:
+                await asyncio.sleep(self.blocked_until - now)
+            elif self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+            elif self.in_flight >= int(self.concurrency):
+                await asyncio.sleep(0.05)
+            else:
+                self.tokens -= 1
+                self.in_flight += 1
+                return
+
+    def release(self, throttled, retry_after=None):
+        self.in_flight -= 1
+        if throttled:
+            self.concurrency = max(1.0, self.concurrency / 2)
+        else:
+            self.concurrency = min(self.max_concurrency, self.concurrency + 1 / self.concurrency)
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + retry_after)
+
+
+class CircuitBreaker(object):
+    """
+    Stops polling a campground for a while after repeated failures, so that a
+    campground that is broken upstream doesn't eat into everyone's budget.
+    Once `cooldown` has passed requests are let through again, and the first
+    success closes the circuit.
+    """
+
+    def __init__(self, threshold, cooldown):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = collections.Counter()
+        self.opened_at = {}
+
+    def allow(self, campground_id):
+        opened_at = self.opened_at.get(campground_id)
+        return opened_at is None or time.monotonic() - opened_at >= self.cooldown
+
+    def success(self, campground_id):
+        self.failures.pop(campground_id, None)
+        self.opened_at.pop(campground_id, None)
+
+    def failure(self, campground_id):
+        self.failures[campground_id] += 1
+        if self.failures[campground_id] >= self.threshold:
+            if campground_id not in self.opened_at:
+                LOGGER.warning("opening circuit for campground %s", campground_id)
+            self.opened_at[campground_id] = time.monotonic()
+
+
+#: Pacing shared by every request to recreation.gov.
+LIMITER = UpstreamLimiter(CRUSHER_UPSTREAM_REQUESTS_PER_SECOND, CRUSHER_FETCH_CONCURRENCY)
+#: Campgrounds that are failing upstream.
+BREAKER = CircuitBreaker(CRUSHER_BREAKER_THRESHOLD, CRUSHER_BREAKER_COOLDOWN_SECONDS)
+#: The error reported for months of a campground whose circuit is open.
+CIRCUIT_OPEN = "skipped after repeated failures"
+
+
+def parse_retry_after(value):
+    """
+    :returns: The seconds to wait from a `Retry-After` header, or None.
+    """
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, (email.utils.parsedate_to_datetime(value) - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt):
+    """
+    Exponential backoff with full jitter.
+    """
+    return random.uniform(0, min(CRUSHER_FETCH_BACKOFF_MAX_SECONDS, CRUSHER_FETCH_BACKOFF_SECONDS * 2 ** attempt))
+
+
+async def request_month(session, cache, campground_id, month):
+    """
+    Makes a single request for a month of availabilities for a campground.
+
+    A sample site payload:
+    {
+        "availabilities": {
+            "2018-10-05T00:00:00Z": "Reserved",
+            ...
+            "2018-10-20T00:00:00Z": "reserved"
+        },
+        "campsite_id": "99",
+        "campsite_reserve_type": "Site-Specific",
+        "loop": "UPPER PINES ",
+        "quantities": null,
+        "site": "043"
+    }
+
+    Only the `MonthGrid` decoded from the response is returned and cached.
+
+    :returns: A tuple of `(status, retry_after, grid, error)`.
+    """
+    key = month_key(campground_id, month)
+    stale = cache.peek(key) if cache is not None else None
+    headers = cache.validators(key) if stale is not None else {}
+    async with session.get(
+        AVAILABILITY_URL.format(id=campground_id),
+        headers=headers,
+        params={
+            'start_date': month.format('YYYY-MM-01T00:00:00.000') + 'Z',
+        },
+    ) as resp:
+        if resp.status == 304 and stale is not None:
+            return resp.status, None, cache.revalidated(key, stale), None
+        if resp.status != 200:
+            text = await resp.text()
+            LOGGER.warning("request failed: %s, %s, %s", campground_id, resp.headers, text)
+            retry_after = parse_retry_after(resp.headers.get('Retry-After'))
+            return resp.status, retry_after, None, "<STATUS %s>: %s" % (resp.status, text)
+        body = await resp.read()
+        try:
+            grid = MonthGrid.parse(month, body)
+        except (ValueError, KeyError, TypeError, AttributeError) as e:
+            # A maintenance page or a payload without campsites. Trying again
+            # right away won't help, so let the breaker count it instead.
+            LOGGER.warning("undecodable response: %s, %r", campground_id, e)
+            return resp.status, None, None, "<UNDECODABLE %s>: %r" % (resp.status, e)
+        if LOGGER.isEnabledFor(logging.DEBUG) and random.random() < CRUSHER_LOG_PAYLOAD_SAMPLE_RATE:
+            LOGGER.debug("response from recreation.gov for %s: %s", key, body.decode('utf-8', 'replace'))
+        if cache is not None:
+            cache.store(
+                key,
+                grid,
+                grid.approximate_size(),
+                etag=resp.headers.get('ETag'),
+                last_modified=resp.headers.get('Last-Modified'),
+            )
+
+    return resp.status, None, grid, None
+
+
+async def fetch_month(session, limiter, cache, campground_id, month):
+    """
+    Fetches a single month of availabilities for a campground, retrying with
+    backoff when we're throttled or recreation.gov is having trouble.
+
+    :returns: A tuple of `(grid, error)`, one of which will be None.
+    """
+    if not BREAKER.allow(campground_id):
+        return None, CIRCUIT_OPEN
+
+    for attempt in range(CRUSHER_FETCH_RETRIES + 1):
+        if attempt:
+            await asyncio.sleep(backoff_delay(attempt))
+        await limiter.acquire()
+        began = time.monotonic()
+        status, retry_after, grid, error = None, None, None, None
+        try:
+            status, retry_after, grid, error = await request_month(session, cache, campground_id, month)
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            LOGGER.warning("request failed: %s: %r", campground_id, e)
+            error = repr(e)
+        finally:
+            # Always hand our slot back, even if something unexpected escapes.
+            retryable = status is None or status == 429 or status >= 500
+            limiter.release(retryable, retry_after)
+        FETCH_SECONDS.labels(campground_id).observe(time.monotonic() - began)
+        FETCHES.labels(str(status) if status is not None else 'error').inc()
+
+        if grid is not None:
+            BREAKER.success(campground_id)
+            return grid, None
+        if not retryable:
+            break
+
+    BREAKER.failure(campground_id)
+    return None, error
+
+
+async def _fetch_months(months, cache, limiter, concurrency, timeout):
+    # A single session per cycle lets requests to recreation.gov share a
+    # keep-alive connection pool, bounded by our concurrency limit.
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        headers={'User-Agent': USER_AGENT},
+        timeout=aiohttp.ClientTimeout(total=timeout),
+    ) as session:
+        keys = list(months)
+        results = await asyncio.gather(*[
+            fetch_month(session, limiter, cache, key[0], months[key])
+            for key in keys
+        ])
+    return dict(zip(keys, results))
+
+
+def fetch_months(months, cache=CACHE, limiter=LIMITER, concurrency=None, timeout=None):
+    """
+    Fetches every planned campground-month once, with at most `concurrency`
+    requests in flight at a time. Months that are still fresh in `cache` are
+    served without making a request.
+
+    Failures are reported to slack as a single summary for the whole batch.
+    Months skipped because their campground's circuit is open were already
+    reported when they failed, so they're only logged.
+
+    :param months: A dict of `month_key` to month start, see `plan_fetches`.
+    :param cache: An `AvailabilityCache`, or None to always fetch.
+    :param limiter: The `UpstreamLimiter` pacing requests.
+    :returns: A dict of `month_key` to `MonthGrid`, or None for failed
+        fetches.
+    """
+    grids = {}
+    stale = {}
+    for key, month in months.items():
+        grid = cache.get(key, month) if cache is not None else None
+        if grid is not None:
+            grids[key] = grid
+        else:
+            stale[key] = month
+
+    results = asyncio.run(_fetch_months(
+        stale,
+        cache,
+        limiter,
+        concurrency or CRUSHER_FETCH_CONCURRENCY,
+        timeout or CRUSHER_FETCH_TIMEOUT_SECONDS,
+    ))
+
+    errors = []
+    skipped = 0
+    for key, (grid, error) in results.items():
+        if error == CIRCUIT_OPEN:
+            skipped += 1
+        elif error is not None:
+            errors.append("{} in {}: {}".format(key[0], key[1], error))
+        grids[key] = grid
+    if skipped:
+        LOGGER.warning("skipped %d campground-months with an open circuit", skipped)
+    if errors:
+        summary = errors[:10]
+        if len(errors) > 10:
+            summary.append("and {} more".format(len(errors) - 10))
+        notify_error("Campsite search failed for {} of {} campground-months:\n{}".format(
+            len(errors),
+            len(stale),
+            "\n".join(summary),
+        ))
+    if cache is not None:
+        LOGGER.info("availability cache: %s", cache.stats())
+    return grids
+
+
+def normalize_name(name):
+    """
+    Loop and site names from recreation.gov come with stray whitespace, e.g.
+    `"UPPER PINES "`, and users type them in any case.
+    """
+    return ' '.join((name or '').split()).casefold()
+
+
+def _collect_sites(grids):
+    """
+    Helps mangle multiple months into a single index of availabilities by site
+    id. Each site's bitmaps are shifted into place so that bit `n` is day `n`
+    counting from the start of the first month.
+    """
+    if len(grids) == 1:
+        return grids[0].sites
+
+    availabilities_by_site = {}
+    offset = 0
+    for grid in grids:
+        for site_id, (site, bitmap) in grid.sites.items():
+            if site_id in availabilities_by_site:
+                site, previous = availabilities_by_site[site_id]
+                bitmap = previous | bitmap << offset
+            else:
+                bitmap = bitmap << offset
+            availabilities_by_site[site_id] = (site, bitmap)
+        offset += grid.days
+    return availabilities_by_site
+
+
+def run(watcher, campground, grids):
+    """
+    Evaluates a watcher against a single campground using months that have
+    already been fetched and decoded for the whole polling cycle.
+
+    Flexible watchers, with an `until` constraint, may arrive on any day from
+    `start` to `until`, see `stay_dates`. Each site is reported with its best
+    arrival date that meets `min_fraction` and `nights`, found with a sliding
+    window over the site's availability, see `best_window`.
+
+    The watcher's other optional `constraints` are applied while scanning
+    sites: sites outside the `loops` or `sites` allow-lists are skipped before
+    anything is computed, sites available for less than `min_fraction` of the
+    stay or without `nights` consecutive available nights are dropped, and
+    with `top` only the best sites are kept in a bounded heap. Once the heap
+    is full of fully available sites nothing else can make the cut, so the
+    scan stops early.
+
+    :param grids: A dict of `month_key` to `MonthGrid`, see `fetch_months`.
+    """
+    constraints = watcher.get('constraints') or {}
+    until = constraints.get('until')
+    date = watcher['start']
+    length = watcher['length']
+    start_date, end_date = stay_dates(watcher)
+
+    months = []
+    for month in stay_months(start_date, end_date):
+        grid = grids.get(month_key(campground['id'], month))
+        if grid is None:
             return []
+        months.append(grid)
+
+    first_day = (start_date - months[0].month).days
+    last_day = (end_date - months[0].month).days - length
+    mask = window_mask(first_day, first_day + length)
 
-        responses.append(resp.json())
-
-    def _collect_sites(responses):
-        """
-        Helps mangle multiple responses into a single index of availbilities by
-        site id.
-        """
-        availabilities_by_site = {}
-        for payload in responses:
-            for site_id, site in payload['campsites'].items():
-                if not availabilities_by_site.get(site_id):
-                    availabilities_by_site[site_id] = {
-                        'site': site,
-                        'availabilities': {},
-                    }
-                availabilities_by_site[site_id]['availabilities'].update(site['availabilities'])
-        return availabilities_by_site
-
-    results = []
-    for site_id, site in _collect_sites(responses).items():
-        avfraction = availability_fraction(site, start_date, end_date)
-        if avfraction > 0:
-            results.append({
-                "date": date,
-                "url": "https://www.recreation.gov/camping/campgrounds/{}/availability".format(campground['id']),
-                "campground": campground,
-                "campsite": site['site'],
-                "fraction": avfraction,
-            })
+    min_fraction = constraints.get('min_fraction', 0)
+    nights = constraints.get('nights', 1)
+    loops = set(map(normalize_name, constraints['loops'])) if 'loops' in constraints else None
+    site_names = set(map(normalize_name, constraints['sites'])) if 'sites' in constraints else None
+    top = constraints.get('top')
+
+    # Entries are `(fraction, -position, site, date)` so that ties go to the
+    # site listed first, as a stable sort would.
+    heap = []
+    for position, (site, bitmap) in enumerate(_collect_sites(months).values()):
+        if top is not None and len(heap) == top and heap[0][0] >= 1:
+            break
+        if loops is not None and normalize_name(site.loop) not in loops:
+            continue
+        if site_names is not None and normalize_name(site.site) not in site_names:
+            continue
+        if until:
+            count, arrival = best_window(bitmap, first_day, last_day, length, min_fraction, nights)
+            bitmap &= window_mask(arrival, arrival + length)
+            site_date = start_date.shift(days=arrival - first_day).format('DD/MM/YY')
+        else:
+            bitmap &= mask
+            count = bin(bitmap).count('1')
+            site_date = date
+        if not count:
+            continue
+        avfraction = count / length
+        if avfraction < min_fraction:
+            continue
+        if nights > 1 and not has_consecutive(bitmap, nights):
+            continue
+        entry = (avfraction, -position, site, site_date)
+        if top is None:
+            heap.append(entry)
+        elif len(heap) < top:
+            heapq.heappush(heap, entry)
+        else:
+            heapq.heappushpop(heap, entry)
 
     # Return the list of sites by their availability fraction of the dates
     # desired since we prefer not to move campsites, but will if we have to.
-    return sorted(results, key=lambda site: site['fraction'], reverse=True)
+    return [
+        {
+            "date": site_date,
+            "url": "https://www.recreation.gov/camping/campgrounds/{}/availability".format(campground['id']),
+            "campground": campground,
+            "campsite": site.to_json(),
+            "fraction": avfraction,
+        }
+        for avfraction, _, site, site_date in sorted(heap, key=lambda entry: entry[:2], reverse=True)
+    ]
 
 
 def mock_watchers():
@@ -189,35 +1672,111 @@ def mock_watchers():
 
 
 def run_all():
-    watchers = get_watchers()
-    LOGGER.info("running watcher loop with %d watchers", len(watchers))
-    for watcher in watchers:
-        date = watcher['start']
-        length_of_stay = watcher['length']
-        campgrounds = campgrounds_by_tag(watcher['campground'])
+    try:
+        CATALOG.refresh()
+        LEASES.claim()
+    except requests.RequestException:
+        LOGGER.exception("failed to reach the API server - skipping cycle.")
+        return
+
+    with LEASES.renewing(), CYCLE_SECONDS.time():
+        run_cycle()
+    LAST_CYCLE.set_to_current_time()
+    LOGGER.info("writing heartbeat to %s", HEARTBEAT_FILENAME)
+    Path(HEARTBEAT_FILENAME).touch()
+
+
+#: The `watcher_spec` of every watcher whose current results the server has,
+#: by watcher id. These only need evaluating again when availability changes.
+EVALUATED_WATCHERS = {}
+
+
+def run_cycle():
+    jobs, months, first_nights = plan_fetches(get_watchers(), owns=LEASES.owns)
+    WATCHERS_OWNED.set(len(jobs))
+    LOGGER.info("running watcher loop with %d watchers", len(jobs))
+    owned = {watcher['id'] for watcher, _, _ in jobs}
+    for watcher_id in set(EVALUATED_WATCHERS) - owned:
+        del EVALUATED_WATCHERS[watcher_id]
+
+    SCHEDULER.update(first_nights, last_changed=SNAPSHOTS.last_changed)
+    due = {key: months[key] for key in SCHEDULER.due()}
+    LOGGER.info("%d of %d campground-months are due", len(due), len(months))
+    MONTHS_DUE.inc(len(due))
+
+    grids = fetch_months(due) if due else {}
+    deltas = SNAPSHOTS.record(grids) if grids else {}
+    for key in due:
+        delta = deltas.get(key)
+        SCHEDULER.record(key, delta.changed if delta is not None and not delta.first else None)
+    LOGGER.info(
+        "%d of %d polled campground-months changed",
+        sum(1 for delta in deltas.values() if delta.changed),
+        len(due),
+    )
+
+    # Results only change when availability changes on the nights a watcher
+    # wants, or when the watcher itself is new or was edited.
+    INDEX.sync(jobs)
+    affected = INDEX.affected(deltas)
+    LOGGER.info("%d watchers are affected by changed availability", len(affected))
+
+    began = time.monotonic()
+    results_by_watcher = {}
+    specs = {}
+    for watcher, campgrounds, keys in jobs:
+        spec = watcher_spec(watcher, campgrounds)
+        if watcher['id'] not in affected and EVALUATED_WATCHERS.get(watcher['id']) == spec:
+            continue
+        for key in keys:
+            # Months that weren't due, or whose fetch failed this cycle, fall
+            # back to the last grid we decoded for them.
+            if grids.get(key) is None:
+                grids[key] = CACHE.peek(key)
+        if any(grids[key] is None for key in keys):
+            LOGGER.debug("skipping watcher %s until all of its months have been fetched", watcher['id'])
+            # The change that made this watcher stale has already been
+            # recorded, so make sure it's evaluated again once we can.
+            EVALUATED_WATCHERS.pop(watcher['id'], None)
+            continue
+
         watcher_id = watcher['id']
-        LOGGER.info("looking for camspites in %s", campgrounds)
+        LOGGER.debug("looking for campsites for watcher %s in %d campgrounds", watcher_id, len(campgrounds))
 
         results = []
         for cg in campgrounds:
-            results.extend(run(
-                watcher,
-                date,
-                length_of_stay,
-                cg,
-            ))
-        send_watcher_results(watcher_id, results)
-    LOGGER.info("writing heartbeat to %s", HEARTBEAT_FILENAME)
-    Path(HEARTBEAT_FILENAME).touch()
+            results.extend(run(watcher, cg, grids))
+        top = (watcher.get('constraints') or {}).get('top')
+        if top is not None and len(campgrounds) > 1:
+            # Each campground kept its own best sites, keep the best overall.
+            results = heapq.nlargest(top, results, key=lambda result: result['fraction'])
+        # Other workers may report on the watcher's other campgrounds.
+        results_by_watcher[watcher_id] = {
+            'campgrounds': [cg['id'] for cg in campgrounds],
+            'results': results,
+        }
+        specs[watcher_id] = spec
+    EVALUATE_SECONDS.observe(time.monotonic() - began)
+    WATCHERS_EVALUATED.inc(len(results_by_watcher))
+    for watcher_id in send_results_batch(results_by_watcher):
+        EVALUATED_WATCHERS[watcher_id] = specs[watcher_id]
 
 
 if __name__ == '__main__':
     LOGGER.info("Started...")
-    schedule.every(CRUSHER_POLLING_INTERVAL_MINUTES).minutes.do(run_all)
-    # Run our scraper on the "rising edge", generally for the sake of
-    # debuggability since we want to invoke the scraper immediately when running
-    # from the command line.
-    run_all()
-    while True:
-        schedule.run_pending()
-        time.sleep(1)
+    if CRUSHER_METRICS_PORT:
+        start_http_server(int(CRUSHER_METRICS_PORT))
+    # Exit cleanly when kubernetes stops us so that our leases are released
+    # right away rather than when they expire.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    schedule.every(CRUSHER_SCHEDULER_TICK_SECONDS).seconds.do(run_all)
+    try:
+        # Run our scraper on the "rising edge", generally for the sake of
+        # debuggability since we want to invoke the scraper immediately when
+        # running from the command line.
+        run_all()
+        while True:
+            schedule.run_pending()
+            time.sleep(1)
+    finally:
+        LEASES.release()
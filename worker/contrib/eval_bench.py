@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Compares evaluating watchers against decoded `MonthGrid` bitmaps with the
+per-site loop that parsed every availability date with arrow.
+
+Run from the worker directory:
+
+    python contrib/eval_bench.py --sites 500 --watchers 20
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import sys
+import time
+
+import arrow
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app  # noqa: E402
+
+
+def make_payload(month, sites):
+    days = (month.shift(months=1) - month).days
+    return {
+        "campsites": {
+            str(site): {
+                "site": "{:03d}".format(site),
+                "loop": "LOOP {}".format(site % 5),
+                "availabilities": {
+                    month.shift(days=day).format('YYYY-MM-DDT00:00:00') + 'Z':
+                        'Available' if random.random() < 0.1 else 'Reserved'
+                    for day in range(days)
+                },
+            }
+            for site in range(sites)
+        },
+    }
+
+
+def legacy_availability_fraction(site, start_date, end_date):
+    total_days = (end_date - start_date).days
+    total_matched = 0.0
+    for avdate, status in list(site['availabilities'].items()):
+        avparsed = arrow.get(avdate)
+        if not (avparsed >= start_date and avparsed < end_date):
+            continue
+        if status.lower() == 'available':
+            total_matched = total_matched + 1
+    return total_matched / total_days
+
+
+def legacy_run(date, length, payload):
+    start_date = arrow.get(date, 'DD/MM/YY')
+    end_date = start_date.shift(days=length)
+    results = {}
+    for site_id, site in payload['campsites'].items():
+        avfraction = legacy_availability_fraction(site, start_date, end_date)
+        if avfraction > 0:
+            results[site['site']] = avfraction
+    return results
+
+
+def grid_run(date, length, grids, campground):
+    return {
+        result['campsite']['site']: result['fraction']
+        for result in app.run({'start': date, 'length': length}, campground, grids)
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sites', type=int, default=500)
+    parser.add_argument('--watchers', type=int, default=20)
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    random.seed(0)
+
+    month = arrow.get('2019-07-01')
+    campground = {'id': '232447'}
+    payload = make_payload(month, args.sites)
+    body = json.dumps(payload).encode('utf-8')
+    watchers = [
+        (month.shift(days=random.randrange(0, 25)).format('DD/MM/YY'), random.randrange(1, 7))
+        for _ in range(args.watchers)
+    ]
+
+    began = time.monotonic()
+    legacy = [legacy_run(date, length, payload) for date, length in watchers]
+    legacy_elapsed = time.monotonic() - began
+
+    began = time.monotonic()
+    key = app.month_key(campground['id'], month)
+    grids = {key: app.MonthGrid.parse(month, body)}
+    decode_elapsed = time.monotonic() - began
+    current = [grid_run(date, length, grids, campground) for date, length in watchers]
+    grid_elapsed = time.monotonic() - began
+
+    assert legacy == current, "grid evaluation disagrees with the legacy loop"
+
+    print("{} sites, {} watchers".format(args.sites, args.watchers))
+    print("{:>10} {:>10.3f}s".format('legacy', legacy_elapsed))
+    print("{:>10} {:>10.3f}s (of which {:.3f}s decoding)".format('grid', grid_elapsed, decode_elapsed))
+
+
+if __name__ == '__main__':
+    main()
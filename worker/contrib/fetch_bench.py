@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""
+Measures polling cycle fetch time against a fake recreation.gov availability
+api that sleeps before answering every request.
+
+Run from the worker directory:
+
+    python contrib/fetch_bench.py --months 40 --latency 0.2 --concurrency 1 8 16
+
+With n campground-months, l seconds of latency and a concurrency limit of c,
+expect a wall time of roughly n * l / c.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+
+import arrow
+from aiohttp import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app  # noqa: E402
+
+
+def make_payload(month, sites=50):
+    days = (month.shift(months=1) - month).days
+    return {
+        "campsites": {
+            str(site): {
+                "site": "{:03d}".format(site),
+                "availabilities": {
+                    month.shift(days=day).format('YYYY-MM-DDT00:00:00') + 'Z':
+                        'Available' if (site + day) % 3 == 0 else 'Reserved'
+                    for day in range(days)
+                },
+            }
+            for site in range(sites)
+        },
+    }
+
+
+def serve(latency, ready):
+    # Payloads are built once per month so that the fake server's own cpu time
+    # doesn't get counted as upstream latency.
+    payloads = {}
+
+    async def availability(request):
+        await asyncio.sleep(latency)
+        start_date = request.query['start_date']
+        if start_date not in payloads:
+            payloads[start_date] = web.json_response(make_payload(arrow.get(start_date))).body
+        return web.Response(body=payloads[start_date], content_type='application/json')
+
+    async def start():
+        server = web.Application()
+        server.router.add_get('/campground/{id}/month', availability)
+        runner = web.AppRunner(server)
+        await runner.setup()
+        site = web.TCPSite(runner, '127.0.0.1', 0)
+        await site.start()
+        ready['port'] = site._server.sockets[0].getsockname()[1]
+        ready['event'].set()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.run_until_complete(start())
+    loop.run_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--months', type=int, default=40, help='distinct campground-months per cycle')
+    parser.add_argument('--latency', type=float, default=0.2, help='fake upstream latency in seconds')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 4, 8, 16])
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    ready = {'event': threading.Event()}
+    threading.Thread(target=serve, args=(args.latency, ready), daemon=True).start()
+    ready['event'].wait()
+    app.AVAILABILITY_URL = 'http://127.0.0.1:{}/campground/{{id}}/month'.format(ready['port'])
+
+    start = arrow.get('2019-06-01')
+    months = {
+        app.month_key(str(i), start): start
+        for i in range(args.months)
+    }
+
+    print("{:>12} {:>10} {:>12}".format('concurrency', 'wall (s)', 'ideal (s)'))
+    for concurrency in args.concurrency:
+        began = time.monotonic()
+        grids = app.fetch_months(
+            months,
+            cache=None,
+            limiter=app.UpstreamLimiter(1000, concurrency),
+            concurrency=concurrency,
+        )
+        elapsed = time.monotonic() - began
+        assert all(grids.values()), "some fetches failed"
+        ideal = args.latency * -(-args.months // concurrency)
+        print("{:>12} {:>10.2f} {:>12.2f}".format(concurrency, elapsed, ideal))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+"""
+Prints when nights at a campsite opened up or were booked, from the worker's
+availability snapshot store.
+
+Run from the worker directory, against the store the worker writes to:
+
+    CRUSHER_SNAPSHOT_PATH=/tmp/crusher-snapshots.sqlite3 \
+        python contrib/history.py 232447 043 --days 7
+"""
+import argparse
+import logging
+import os
+import sys
+import time
+
+import arrow
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import app  # noqa: E402
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('campground', help='recreation.gov campground id')
+    parser.add_argument('site', help='site number, e.g. 043')
+    parser.add_argument('--days', type=float, default=7, help='how far back to look')
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+
+    since = time.time() - args.days * 86400
+    history = app.SNAPSHOTS.history(args.campground, args.site, since=since)
+    if not history:
+        print("no changes at site {} of {} in the last {:g} days".format(args.site, args.campground, args.days))
+        return
+    for observed_at, date, opened in history:
+        print("{}  {}  {}".format(
+            arrow.get(observed_at).format('YYYY-MM-DD HH:mm:ss'),
+            date.format('YYYY-MM-DD'),
+            'opened' if opened else 'booked',
+        ))
+
+
+if __name__ == '__main__':
+    main()